@@ -0,0 +1,370 @@
+import asyncio
+import contextlib
+import hashlib
+import http.server
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import typing
+import uuid
+
+import agents
+import httpx
+from agents.tool_context import ToolContext
+from openai.types.responses import Response, ResponseCompletedEvent, ResponseOutputMessage, ResponseOutputText
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def load(name: str):
+    spec = importlib.util.spec_from_file_location(f"{name}_agent", os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+class TraceServer:
+
+    upstreams = {"openai": "https://api.openai.com", "anthropic": "https://api.anthropic.com", "gemini": "https://generativelanguage.googleapis.com"}
+
+    def __init__(self, path: str, record: bool = False):
+        self.path = path
+        self.record = record
+        self.lock = threading.Lock()
+        self.entries = []
+        self.used = set()
+        self.misses = 0
+        if record:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            open(path, "w", encoding="utf-8").close()
+        else:
+            with open(path, encoding="utf-8") as f:
+                self.entries = [json.loads(line) for line in f if line.strip()]
+        self.client = httpx.Client(timeout=600) if record else None
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+
+    @staticmethod
+    def keys(path: str, body: bytes) -> tuple[str, str]:
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            request = {}
+        tools = sorted(str(_.get("name") or _.get("function", {}).get("name") or _.get("type")) for _ in request.get("tools") or [] if isinstance(_, dict))
+        agent = hashlib.sha1(json.dumps([path, request.get("model"), tools]).encode()).hexdigest()
+        return hashlib.sha1(path.encode() + body).hexdigest(), agent
+
+    def handler(self):
+        trace = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("content-length") or 0))
+                status, content_type, content = trace.respond(self.command, self.path, dict(self.headers), body)
+                self.send_response(status)
+                self.send_header("content-type", content_type)
+                self.send_header("content-length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+            do_GET = do_POST
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def respond(self, method: str, path: str, headers: dict, body: bytes) -> tuple[int, str, bytes]:
+        exact, agent = self.keys(path, body)
+        prefix, _, rest = path.lstrip("/").partition("/")
+        if self.record and prefix in self.upstreams:
+            headers = {k: v for k, v in headers.items() if k.lower() not in ("host", "content-length", "accept-encoding", "connection")}
+            response = self.client.request(method, f"{self.upstreams[prefix]}/{rest}", headers=headers, content=body)
+            content_type = response.headers.get("content-type", "application/json")
+            if response.status_code < 400:
+                entry = {"path": path, "exact": exact, "agent": agent, "status": response.status_code, "content_type": content_type, "body": response.text}
+                with self.lock, open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+            return response.status_code, content_type, response.content
+        with self.lock:
+            candidates = [i for i in range(len(self.entries)) if i not in self.used]
+            index = next((i for i in candidates if self.entries[i]["exact"] == exact), None)
+            index = next((i for i in candidates if self.entries[i]["agent"] == agent), None) if index is None else index
+            if index is None:
+                self.misses += 1
+                return 404, "application/json", json.dumps({"error": {"message": f"No recorded response for {path}", "type": "not_found"}}).encode()
+            self.used.add(index)
+        entry = self.entries[index]
+        return entry["status"], entry["content_type"], entry["body"].encode()
+
+    @property
+    def environment(self) -> dict[str, str]:
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        environment = {"OPENAI_BASE_URL": f"{url}/openai/v1", "ANTHROPIC_BASE_URL": f"{url}/anthropic/v1/", "GEMINI_BASE_URL": f"{url}/gemini/v1beta/"}
+        if not self.record:
+            environment["OPENAI_AGENTS_DISABLE_TRACING"] = "1"
+            environment.update({key: os.environ.get(key) or "replay" for key in ("OPENAI_API_KEY", "ANTHROPIC_API_KEY", "GEMINI_API_KEY")})
+        return dict(os.environ) | environment
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.client:
+            self.client.close()
+
+class ScriptedModel(agents.Model):
+
+    def __init__(self, respond: typing.Callable[[str | list], str], latency: float = 0.05, jitter: float = 0.5):
+        self.respond = respond
+        self.latency = latency
+        self.jitter = jitter
+
+    async def get_response(self, system_instructions, input, model_settings, tools, output_schema, handoffs, tracing, **kwargs) -> agents.ModelResponse:
+        await asyncio.sleep(self.latency * (1 + self.jitter * (2 * random.random() - 1)))
+        content = [ResponseOutputText(type="output_text", text=self.respond(input), annotations=[])]
+        message = ResponseOutputMessage(id=f"msg_{uuid.uuid4().hex}", type="message", role="assistant", status="completed", content=content)
+        return agents.ModelResponse(output=[message], usage=agents.Usage(requests=1), response_id=None)
+
+    async def stream_response(self, system_instructions, input, model_settings, tools, output_schema, handoffs, tracing, **kwargs):
+        response = await self.get_response(system_instructions, input, model_settings, tools, output_schema, handoffs, tracing, **kwargs)
+        yield ResponseCompletedEvent.model_construct(type="response.completed", sequence_number=0, response=Response.model_construct(id=f"resp_{uuid.uuid4().hex}", output=response.output, usage=None))
+
+class SyntheticScreen:
+
+    def __init__(self, size: tuple[int, int], frames: int = 8, seed: int = 0):
+        import PIL.Image
+        import PIL.ImageDraw
+        rng = random.Random(seed)
+        base = PIL.Image.new("RGB", size, (236, 236, 236))
+        draw = PIL.ImageDraw.Draw(base)
+        for _ in range(size[0] * size[1] // 4000):
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            draw.rectangle((x, y, x + rng.randint(8, 240), y + rng.randint(4, 40)), fill=tuple(rng.randrange(256) for _ in range(3)))
+        for y in range(0, size[1], 18):
+            draw.text((rng.randint(0, 40), y), " ".join(f"word{rng.randrange(1000)}" for _ in range(size[0] // 60)), fill=(20, 20, 20))
+        self.frames = [base]
+        for _ in range(frames - 1):
+            frame = self.frames[-1].copy()
+            x, y = rng.randrange(size[0]), rng.randrange(size[1])
+            PIL.ImageDraw.Draw(frame).rectangle((x, y, x + 200, y + 60), fill=tuple(rng.randrange(256) for _ in range(3)))
+            self.frames.append(frame)
+        self.dimensions = size
+        self.index = 0
+
+    def size(self) -> tuple[int, int]:
+        return self.dimensions
+
+    def screenshot(self):
+        return self.frames[self.index % len(self.frames)]
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: None
+
+class Benchmark:
+
+    def __init__(self, iterations: int):
+        self.iterations = iterations
+        self.results = {}
+
+    @staticmethod
+    def summarize(timings: list[float], memory: int | None) -> dict:
+        timings = sorted(_ * 1000 for _ in timings)
+        pick = lambda q: timings[min(len(timings) - 1, round(q * (len(timings) - 1)))]
+        return {"count": len(timings), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "mean": sum(timings) / len(timings), "memory": memory}
+
+    async def measure(self, name: str, func: typing.Callable, prepare: typing.Callable | None = None, iterations: int | None = None):
+        iterations = iterations or self.iterations
+        timings = []
+        for i in range(iterations + 1):
+            args = prepare(i) if prepare else (i,)
+            if i == iterations:
+                tracemalloc.start()
+            start = time.perf_counter()
+            await func(*args)
+            if i < iterations:
+                timings.append(time.perf_counter() - start)
+        _, memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.results[name] = self.summarize(timings, memory)
+
+def synthesize(path: str, files: int, lines: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    words = ["alpha", "beta", "gamma", "delta", "config", "request", "buffer", "index", "cache", "token", "value", "result"]
+    shutil.rmtree(path, ignore_errors=True)
+    paths = []
+    for i in range(files):
+        file = os.path.join(path, f"package_{i % 16}", f"module_{i}.py")
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        with open(file, "w", encoding="utf-8") as f:
+            f.write(f"def function_{i}(x):\n")
+            f.writelines(f"    value_{i}_{j} = compute({', '.join(rng.choice(words) for _ in range(rng.randint(1, 6)))})\n" for j in range(lines))
+        paths.append(file)
+    os.makedirs(os.path.join(path, "build"), exist_ok=True)
+    with open(os.path.join(path, ".gitignore"), "w", encoding="utf-8") as f:
+        f.write("build/\n*.log\n")
+    return paths
+
+async def bench_code(benchmark: Benchmark, options: dict):
+    code = load("code")
+    count, lines = int(options.get("files") or 200), int(options.get("lines") or 1000)
+    directory = tempfile.mkdtemp(prefix="bench-code-")
+    files = synthesize(directory, count, lines)
+    workspace = code.Workspace(directory)
+    tools = {tool.name: tool for tool in [code.str_replace_editor, code.search, code.bash, code.apply_patch]}
+    async def call(name: str, **args):
+        arguments = json.dumps(args)
+        result = await tools[name].on_invoke_tool(ToolContext(workspace, tool_name=name, tool_call_id=uuid.uuid4().hex, tool_arguments=arguments), arguments)
+        if str(result).startswith("An error occurred"):
+            raise RuntimeError(f"{name} failed: {result}")
+    def patch(i: int) -> tuple[str]:
+        file, line = files[(i + count // 2) % count], lines // 2 + i // count * 4
+        with open(file, encoding="utf-8") as f:
+            context = f.read().split("\n")[line - 1 : line + 2]
+        text = "\n".join(["*** Begin Patch", f"*** Update File: {os.path.relpath(file, directory)}", "@@", f" {context[0]}", f"-{context[1]}", f"+{context[1]}  # patched", f" {context[2]}", "*** End Patch"])
+        return (text,)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.to_thread(workspace.search_index.ready.wait)
+            await benchmark.measure("code.editor.view", lambda i: call("str_replace_editor", command="view", path=files[i % count]))
+            await benchmark.measure("code.editor.view_range", lambda i: call("str_replace_editor", command="view", path=files[i % count], view_range=[lines // 2, lines // 2 + 40]))
+            await benchmark.measure("code.editor.str_replace", lambda i: call("str_replace_editor", command="str_replace", path=files[i % count], old_str=f"value_{i % count}_{1 + i // count} = ", new_str=f"value_{i % count}_{1 + i // count}_edited = "))
+            await benchmark.measure("code.editor.insert", lambda i: call("str_replace_editor", command="insert", path=files[i % count], insert_line=lines // 4, new_str="    # inserted"))
+            await benchmark.measure("code.apply_patch", lambda text: call("apply_patch", patch_text=text), patch)
+            await benchmark.measure("code.search.literal", lambda i: call("search", query=f"value_{i % count}_{lines - 1} = ", path=directory))
+            await benchmark.measure("code.search.regex", lambda i: call("search", query=rf"value_{i % count}_\d+0 = compute\(alpha", path=directory, regex=True))
+            await benchmark.measure("code.bash.read", lambda i: call("bash", command=f"wc -l {files[i % count]}"))
+            await benchmark.measure("code.bash.write", lambda i: call("bash", command=f"touch {files[i % count]}"))
+    finally:
+        await workspace.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+async def bench_cua(benchmark: Benchmark, options: dict):
+    cua = load("cua")
+    size = tuple(int(_) for _ in (options.get("screen") or "1920x1080").split("x"))
+    screen = SyntheticScreen(size)
+    def change(i: int) -> tuple[()]:
+        screen.index = i
+        return ()
+    computer = cua.LocalComputer(input=screen)
+    try:
+        await benchmark.measure("cua.screenshot.png", computer.screenshot, change)
+        await benchmark.measure("cua.screenshot.png.unchanged", computer.screenshot, lambda i: ())
+        await benchmark.measure("cua.click", lambda i: computer.click(i % computer.size[0], i % computer.size[1]))
+        await benchmark.measure("cua.wait", lambda i: computer.wait(1000))
+    finally:
+        computer.close()
+
+async def bench_research(benchmark: Benchmark, options: dict):
+    research = load("research")
+    count, latency = int(options.get("searches") or 20), float(options.get("latency") or 50) / 1000
+    rng = random.Random(0)
+    topics = ["python", "rust", "go", "kubernetes", "postgres", "redis", "kafka", "react", "llm", "gpu"]
+    aspects = ["performance", "benchmarks", "release notes", "security advisories", "best practices", "migration guide"]
+    searches = [research.SearchQuery(reason="benchmark", query=f"{rng.choice(topics)} {rng.choice(aspects)} {i}") for i in range(count)]
+    summary = " ".join(rng.choice(topics + aspects) for _ in range(250))
+    search = agents.Agent(name="Search", instructions="Search", model=ScriptedModel(lambda _: summary, latency))
+    condense = agents.Agent(name="Condense", instructions="Condense", model=ScriptedModel(lambda _: summary[:2000], latency))
+    async def fanout(i: int):
+        scheduler = research.SearchScheduler()
+        condenser = research.Condenser(condense)
+        async def search_pair(item):
+            result = await agents.Runner.run(search, f"Search term: {item.query}")
+            return item, str(result.final_output)
+        async for item, text in scheduler.run(search_pair, searches):
+            condenser.add(item, text)
+        research.reduce(await condenser.finish())
+    await benchmark.measure("research.fanout", fanout, iterations=max(3, benchmark.iterations // 4))
+
+def replay(trace: str, script: str, argv: list[str], options: dict) -> dict:
+    runs = int(options.get("runs") or 5)
+    timings, failures = [], 0
+    with TraceServer(trace) as server:
+        for _ in range(runs):
+            if options.get("repo"):
+                synthesize(options["repo"], int(options.get("files") or 200), int(options.get("lines") or 1000))
+            server.used.clear()
+            start = time.perf_counter()
+            output = None if "verbose" in options else subprocess.DEVNULL
+            process = subprocess.run([sys.executable, script, *argv], env=server.environment, stdin=subprocess.DEVNULL, stdout=output, stderr=output, check=False)
+            timings.append(time.perf_counter() - start)
+            failures += process.returncode != 0
+    memory = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * (1 if sys.platform == "darwin" else 1024) if resource else None
+    if failures or server.misses:
+        print(f"\033[90m   {failures} failed runs, {server.misses} requests without a recorded response\033[0m")
+    return Benchmark.summarize(timings, memory)
+
+def report(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    print(f"\n{'benchmark':<32}{'n':>5}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'memory':>10}{'baseline':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        memory = f"{result['memory'] / (1 << 20):.1f} MB" if result["memory"] is not None else "-"
+        delta = ""
+        if base and base["p50"]:
+            change = result["p50"] / base["p50"] - 1
+            color = "\033[31m" if change > threshold else "\033[32m" if change < -threshold else "\033[90m"
+            delta = f"{color}{change:+.0%}\033[0m".rjust(19)
+            if change > threshold:
+                regressions.append(name)
+        print(f"{name:<32}{result['count']:>5}{result['p50']:>10.2f}{result['p90']:>10.2f}{result['p99']:>10.2f}{memory:>10}{delta}")
+    return regressions
+
+async def main():
+    args = sys.argv[1:]
+    command = args.pop(0) if args and args[0] in ("record", "replay") else None
+    options = {}
+    while args and args[0].startswith("--"):
+        options.update([args.pop(0)[2:].partition("=")[::2]])
+    if command and len(args) < 2:
+        print("Usage: python bench.py [code] [cua] [research] [--iterations=20] [--files=200] [--lines=1000] [--screen=1920x1080] [--searches=20] [--latency=50] [--baseline=bench.json] [--save] [--threshold=0.25]")
+        print("       python bench.py record [--repo=<directory>] <trace.jsonl> <script.py> [args...]")
+        print("       python bench.py replay [--repo=<directory>] [--runs=5] [--verbose] <trace.jsonl> <script.py> [args...]")
+        sys.exit(1)
+    if command == "record":
+        if options.get("repo"):
+            synthesize(options["repo"], int(options.get("files") or 200), int(options.get("lines") or 1000))
+        with TraceServer(args[0], record=True) as server:
+            process = subprocess.run([sys.executable, *args[1:]], env=server.environment, check=False)
+        print(f"Recorded to {args[0]}")
+        sys.exit(process.returncode)
+    if command is None:
+        options.update(dict(_[2:].partition("=")[::2] for _ in args if _.startswith("--")))
+    benchmark = Benchmark(int(options.get("iterations") or 20))
+    if command == "replay":
+        benchmark.results[f"replay.{os.path.splitext(os.path.basename(args[1]))[0]}"] = replay(args[0], args[1], args[2:], options)
+    else:
+        agents.set_tracing_disabled(True)
+        suites = {"code": bench_code, "cua": bench_cua, "research": bench_research}
+        for name in [_ for _ in args if not _.startswith("--")] or list(suites):
+            print(f"\U0001F3C1 {name}")
+            try:
+                await suites[name](benchmark, options)
+            except ImportError as error:
+                print(f"\033[90m   Skipped, {error}\033[0m")
+    path = options.get("baseline") or "bench.json"
+    baseline = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = report(benchmark.results, baseline, float(options.get("threshold") or 0.25))
+    if "save" in options:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(baseline | benchmark.results, f, indent=2)
+        print(f"Baseline saved to {path}")
+    elif regressions:
+        print(f"Regressions against {path}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
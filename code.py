@@ -1,26 +1,571 @@
+import array
 import asyncio
+import bisect
+import concurrent.futures
+import functools
+import hashlib
+import inspect
+import itertools
+import json
+import mmap
 import os
+import re
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import typing
+import uuid
 
 import agents
 import openai
 
+import telemetry
+
 
 def read_file(path: str):
     with open(path, encoding="utf-8") as f:
         return f.read()
 
+umask = os.umask(0o022)
+os.umask(umask)
+
+def stage_file(path: str, file: str) -> str:
+    directory, name = os.path.split(path)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(file)
+        if os.path.exists(path):
+            shutil.copymode(path, temp)
+        else:
+            os.chmod(temp, 0o666 & ~umask)
+        return temp
+    except BaseException:
+        os.remove(temp)
+        raise
+
 def write_file(path: str, file: str):
-    with open(path, "w", encoding="utf-8") as f:
-        return f.write(file)
+    path = os.path.realpath(path)
+    os.replace(stage_file(path, file), path)
+
+class FileBuffer:
+
+    def __init__(self, content: str):
+        self.content = content
+        self.starts = None
+
+    @property
+    def offsets(self) -> list[int]:
+        if self.starts is None:
+            self.starts = [0, *itertools.accumulate(len(line) + 1 for line in self.content.split("\n"))]
+        return self.starts
+
+    @property
+    def count(self) -> int:
+        return len(self.offsets) - 1
+
+    def line(self, offset: int) -> int:
+        return bisect.bisect_right(self.offsets, offset) - 1
+
+    @property
+    def size(self) -> int:
+        return len(self.content)
+
+    def offset(self, line: int) -> int:
+        return self.offsets[line]
+
+    def length(self, text: str) -> int:
+        return len(text)
+
+    def lines(self, first: int, last: int | None = None) -> str:
+        last = self.count if last is None else min(last, self.count)
+        return self.content[self.offsets[first] : self.offsets[last] - 1] if first < last else ""
+
+    def find(self, text: str, limit: int) -> list[int]:
+        offsets, index = [], self.content.find(text)
+        while index != -1 and len(offsets) < limit:
+            offsets.append(index)
+            index = self.content.find(text, index + len(text))
+        return offsets
+
+    def finditer(self, pattern: re.Pattern):
+        return pattern.finditer(self.content)
+
+    def write(self, path: str):
+        write_file(path, self.content)
+
+    def replace(self, start: int, end: int, text: str):
+        first, last = self.line(start), self.line(end)
+        delta = len(text) - (end - start)
+        offsets = [start + i + 1 for i, c in enumerate(text) if c == "\n"] if "\n" in text else []
+        self.content = self.content[:start] + text + self.content[end:]
+        self.offsets[first + 1 : last + 1] = offsets
+        for i in range(first + 1 + len(offsets), len(self.offsets)):
+            self.offsets[i] += delta
+
+class MappedBuffer:
+
+    block = 1 << 16
+    limit = 1 << 20
+
+    def __init__(self, path: str, key: tuple[int, int, int]):
+        self.path = path
+        self.open(key)
+
+    def open(self, key: tuple[int, int, int]):
+        self.key = key
+        self.data = b""
+        if key[1] > 0:
+            with open(self.path, "rb") as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blocks = None
+        self.edit = None
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    @property
+    def index(self) -> array.array:
+        if self.blocks is None:
+            file = os.path.join(os.path.expanduser("~"), ".cache", "agents", "code", "index", hashlib.sha1(self.path.encode()).hexdigest())
+            blocks = array.array("q")
+            try:
+                with open(file, "rb") as f:
+                    blocks.frombytes(f.read())
+            except (OSError, ValueError):
+                pass
+            if tuple(blocks[:3]) == self.key:
+                self.blocks = blocks[3:]
+            else:
+                self.blocks = array.array("q", [0])
+                for start in range(0, len(self.data), self.block):
+                    self.blocks.append(self.blocks[-1] + self.data[start : start + self.block].count(b"\n"))
+                os.makedirs(os.path.dirname(file), exist_ok=True)
+                with open(file, "wb") as f:
+                    f.write(array.array("q", self.key).tobytes() + self.blocks.tobytes())
+        return self.blocks
+
+    @property
+    def count(self) -> int:
+        return self.index[-1] + 1
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    def offset(self, line: int) -> int:
+        if line <= 0 or line >= self.count:
+            return 0 if line <= 0 else len(self.data) + 1
+        block = bisect.bisect_left(self.index, line) - 1
+        position = block * self.block - 1
+        for _ in range(line - self.index[block]):
+            position = self.data.find(b"\n", position + 1)
+        return position + 1
+
+    def line(self, offset: int) -> int:
+        block = offset // self.block
+        return self.index[block] + self.data[block * self.block : offset].count(b"\n")
+
+    def length(self, text: str) -> int:
+        return len(text.encode())
+
+    def lines(self, first: int, last: int | None = None) -> str:
+        last = self.count if last is None else min(last, self.count)
+        if first >= last:
+            return ""
+        start = self.offset(first)
+        end = min(self.offset(last) - 1, start + self.limit)
+        return self.data[start:end].decode("utf-8", errors="replace").replace("\r\n", "\n")
+
+    def find(self, text: str, limit: int) -> list[int]:
+        data = text.encode()
+        offsets, index = [], self.data.find(data)
+        while index != -1 and len(offsets) < limit:
+            offsets.append(index)
+            index = self.data.find(data, index + len(data))
+        return offsets
+
+    def finditer(self, pattern: re.Pattern):
+        return re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE).finditer(self.data)
+
+    def replace(self, start: int, end: int, text: str):
+        self.edit = (start, end, text.encode())
+
+    def write(self, path: str):
+        start, end, data = self.edit
+        path = os.path.realpath(path)
+        directory, name = os.path.split(path)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for position in range(0, start, self.limit):
+                    f.write(self.data[position : min(position + self.limit, start)])
+                f.write(data)
+                for position in range(end, len(self.data), self.limit):
+                    f.write(self.data[position : position + self.limit])
+            shutil.copymode(path, temp)
+        except BaseException:
+            os.remove(temp)
+            raise
+        self.close()
+        os.replace(temp, path)
+        stat = os.stat(path)
+        self.open((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+
+class FileCache:
+
+    def __init__(self, threshold: int = 16 << 20):
+        self.threshold = threshold
+        self.buffers = {}
+
+    def key(self, path: str) -> tuple[int, int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def open(self, path: str, key: tuple[int, int, int] | None = None, expand_tabs: bool = True) -> FileBuffer | MappedBuffer:
+        key = key or self.key(path)
+        if key[1] > self.threshold:
+            return MappedBuffer(path, key)
+        return FileBuffer(read_file(path).expandtabs() if expand_tabs else read_file(path))
+
+    def read(self, path: str) -> FileBuffer | MappedBuffer:
+        path = os.path.abspath(path)
+        key = self.key(path)
+        entry = self.buffers.get(path)
+        if entry and entry[0] == key:
+            return entry[1]
+        if entry and isinstance(entry[1], MappedBuffer):
+            entry[1].close()
+        buffer = self.open(path, key)
+        self.buffers[path] = (key, buffer)
+        return buffer
+
+    def write(self, path: str, buffer: FileBuffer | MappedBuffer):
+        path = os.path.abspath(path)
+        try:
+            buffer.write(path)
+        except BaseException:
+            self.buffers.pop(path, None)
+            raise
+        self.buffers[path] = (self.key(path), buffer)
+
+    def close(self):
+        for _, buffer in list(self.buffers.values()):
+            if isinstance(buffer, MappedBuffer):
+                buffer.close()
+        self.buffers.clear()
+
+def translate(pattern: str) -> str:
+    result = ""
+    for part in re.split(r"(\\.|/\*\*/|\*\*/|/\*\*|\*\*|\*|\?|\[[^\]]*\])", pattern):
+        tokens = {"/**/": "/(?:.*/)?", "**/": "(?:.*/)?", "/**": "/.*", "**": ".*", "*": "[^/]*", "?": "[^/]"}
+        result += tokens.get(part, ("[^" + part[2:] if part.startswith("[!") else part) if part.startswith("[") else re.escape(part[1:] if part.startswith("\\") else part))
+    return result
+
+class WorkspaceIndex:
+
+    def __init__(self):
+        self.directories = {}
+        self.ignores = {}
+
+    def entries(self, path: str) -> list[tuple[str, bool, bool]]:
+        mtime = os.stat(path).st_mtime_ns
+        entry = self.directories.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1]
+        with os.scandir(path) as iterator:
+            entries = sorted((_.name, _.is_dir(), _.is_symlink()) for _ in iterator)
+        self.directories[path] = (mtime, entries)
+        return entries
+
+    def rules(self, path: str) -> list[tuple[str, re.Pattern, bool, bool, bool]]:
+        file = os.path.join(path, ".gitignore")
+        try:
+            key = os.stat(file).st_mtime_ns
+        except OSError:
+            return []
+        entry = self.ignores.get(path)
+        if entry and entry[0] == key:
+            return entry[1]
+        rules = []
+        for line in read_file(file).splitlines():
+            line = re.sub(r"(?<!\\)\s+$", "", line)
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            line = line[1:] if negate else line
+            directory = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            rules.append((path, re.compile(translate(line.lstrip("/")) + "$"), negate, directory, anchored))
+        self.ignores[path] = (key, rules)
+        return rules
+
+    def ignored(self, path: str, is_dir: bool, rules: list) -> bool:
+        ignored = False
+        for base, pattern, negate, directory, anchored in rules:
+            if (is_dir or not directory) and pattern.match(os.path.relpath(path, base).replace(os.sep, "/") if anchored else os.path.basename(path)):
+                ignored = not negate
+        return ignored
+
+    def walk(self, path: str, depth: int, root: str | None = None):
+        path = os.path.abspath(path)
+        rules = []
+        if root and os.path.commonpath([root, path]) == root:
+            parents = [path]
+            while parents[-1] != root:
+                parents.append(os.path.dirname(parents[-1]))
+            for parent in reversed(parents[1:]):
+                rules = rules + self.rules(parent)
+        def scan(directory: str, level: int, rules: list):
+            rules = rules + self.rules(directory)
+            for name, is_dir, is_link in self.entries(directory):
+                child = os.path.join(directory, name)
+                if name.startswith(".") or self.ignored(child, is_dir, rules):
+                    continue
+                yield child, is_dir
+                if is_dir and not is_link and level < depth:
+                    yield from scan(child, level + 1, rules)
+        yield from scan(path, 1, rules)
+
+class SearchIndex:
+
+    def __init__(self, workspace_index: WorkspaceIndex, limit: int = 1 << 20, interval: float = 10):
+        self.workspace_index = workspace_index
+        self.limit = limit
+        self.interval = interval
+        self.root = None
+        self.files = {}
+        self.paths = []
+        self.postings = {}
+        self.pending = set()
+        self.dirty = False
+        self.refreshed = 0
+        self.lock = threading.RLock()
+        self.ready = threading.Event()
+
+    def start(self, root: str):
+        self.root = root
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    @staticmethod
+    def trigrams(data: bytes) -> set[bytes]:
+        data = data.lower()
+        return {data[i : i + 3] for i in range(len(data) - 2)}
+
+    @staticmethod
+    def literals(pattern: str) -> list[str]:
+        if "|" in pattern:
+            return []
+        runs, run, depth = [], "", 0
+        for token in re.findall(r"\\(?:x[0-9a-fA-F]{0,2}|u[0-9a-fA-F]{0,4}|U[0-9a-fA-F]{0,8}|N\{[^}]*\}|\d+|.)|\[\^?\]?(?:\\.|[^\]])*\]|\{\d*,?\d*\}|.", pattern, re.DOTALL):
+            if token in ("*", "?") or token.startswith("{") and len(token) > 1:
+                runs.append(run[:-1])
+                run = ""
+            elif token == "+":
+                runs.append(run)
+                run = ""
+            elif token in ("(", ")"):
+                depth += 1 if token == "(" else -1
+                runs.append(run)
+                run = ""
+            elif depth > 0:
+                continue
+            elif len(token) == 1 and token not in ".^$[]":
+                run += token
+            elif len(token) == 2 and token[0] == "\\" and not token[1].isalnum():
+                run += token[1]
+            else:
+                runs.append(run)
+                run = ""
+        return [_ for _ in runs + [run] if len(_) >= 3]
+
+    def update(self, path: str):
+        try:
+            stat = os.stat(path)
+            key = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            key = None
+        entry = self.files.get(path)
+        if entry and entry[0] == key:
+            return
+        trigrams = None
+        if key and stat.st_size <= self.limit:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                trigrams = set() if b"\0" in data[:8192] else self.trigrams(data)
+            except OSError:
+                key = None
+        with self.lock:
+            if entry and entry[1] >= 0:
+                self.paths[entry[1]] = None
+            if key is None:
+                self.files.pop(path, None)
+            elif trigrams is None:
+                self.files[path] = (key, -1)
+            else:
+                self.files[path] = (key, len(self.paths))
+                for trigram in trigrams:
+                    self.postings.setdefault(trigram, array.array("I")).append(len(self.paths))
+                self.paths.append(path)
+
+    def invalidate(self, path: str):
+        path = os.path.abspath(path)
+        if self.root and path.startswith(os.path.join(self.root, "")):
+            self.pending.add(path)
+
+    def refresh(self):
+        with self.lock:
+            paths = {path for path, is_dir in self.workspace_index.walk(self.root, sys.maxsize, self.root) if not is_dir}
+            for path in set(self.files) - paths:
+                self.update(path)
+            for path in paths:
+                self.update(path)
+            if len(self.paths) > 2 * len(self.files) + 4096:
+                self.postings = {trigram: array.array("I", (_ for _ in ids if self.paths[_] is not None)) for trigram, ids in self.postings.items()}
+            self.dirty = False
+            self.refreshed = time.monotonic()
+        self.ready.set()
+
+    def search(self, literals: list[str], path: str, glob: str | None = None) -> list[str]:
+        path = os.path.abspath(path)
+        if not self.ready.is_set():
+            candidates = {path} if os.path.isfile(path) else {file for file, is_dir in self.workspace_index.walk(path, sys.maxsize, self.root) if not is_dir}
+        else:
+            with self.lock:
+                if self.dirty or time.monotonic() - self.refreshed > self.interval:
+                    self.refresh()
+                pending, self.pending = self.pending, set()
+                for file in pending:
+                    self.update(file)
+                ids = None
+                for posting in sorted((self.postings.get(_, ()) for _ in set().union(*(self.trigrams(_.encode()) for _ in literals)) if _.isascii()), key=len):
+                    ids = set(posting) if ids is None else ids.intersection(posting)
+                if ids is None:
+                    candidates = set(self.files)
+                else:
+                    candidates = {self.paths[_] for _ in ids if self.paths[_] is not None}
+                    candidates |= {file for file, (_, id) in self.files.items() if id < 0}
+        matcher = re.compile(translate(glob)) if glob else None
+        files = []
+        for file in sorted(candidates):
+            relative = os.path.relpath(file, self.root).replace(os.sep, "/")
+            if (file == path or file.startswith(os.path.join(path, ""))) and (not matcher or matcher.fullmatch(relative) or matcher.fullmatch(os.path.basename(file))):
+                files.append(file)
+        return files
+
+def read_only(command: str | list[str]) -> bool:
+    if isinstance(command, list):
+        if len(command) == 3 and os.path.basename(command[0]) in ("bash", "sh") and command[1] in ("-c", "-lc"):
+            return read_only(command[2])
+        command = shlex.join(command)
+    command = command.replace("2>&1", "").replace("2>/dev/null", "")
+    if re.search(r"[`>]|\$\(|<\(", command):
+        return False
+    for segment in re.split(r"\|\||&&|[|;&\n]", command):
+        try:
+            words = shlex.split(segment)
+        except ValueError:
+            return False
+        if not words:
+            continue
+        name = os.path.basename(words[0])
+        if name == "git":
+            allowed = len(words) > 1 and words[1] in ("diff", "log", "show", "status", "blame", "grep", "ls-files") and not any(word.startswith(("--output", "-O", "--open-files-in-pager", "--ext-diff")) for word in words)
+        elif name == "sed":
+            scripts = [word[13:] if word.startswith("--expression=") else words[i + 1] for i, word in enumerate(words[:-1]) if word in ("-e", "--expression") or word.startswith("--expression=")]
+            scripts = scripts or [next((word for word in words[1:] if not word.startswith("-")), "")]
+            allowed = "-n" in words and not any(word.startswith(("-i", "--in-place", "-f", "--file")) for word in words) and not any(re.search(r"(?:^|[\s;{}\d$/,])[gpiImM\d\s]*[wWe]", script) for script in scripts)
+        elif name == "find":
+            allowed = not {"-delete", "-exec", "-execdir", "-ok", "-okdir", "-fprint", "-fprint0", "-fprintf", "-fls"} & set(words)
+        elif name == "tree":
+            allowed = "-o" not in words
+        elif name == "rg":
+            allowed = not any(word == "--pre" or word.startswith("--pre=") for word in words)
+        else:
+            allowed = name in ("cat", "grep", "egrep", "fgrep", "ls", "head", "tail", "wc", "pwd", "tree", "file", "stat", "du", "nl", "diff")
+        if not allowed:
+            return False
+    return True
+
+class ToolScheduler:
+
+    def __init__(self, max_workers: int = 8):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.semaphore = asyncio.Semaphore(max_workers)
+        self.writer = None
+        self.readers = set()
+
+    @staticmethod
+    def tool(is_read_only: typing.Callable[..., bool]):
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(ctx, *args, **kwargs):
+                return await ctx.context.scheduler.run(func, is_read_only(*args, **kwargs), ctx, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    async def run(self, func: typing.Callable, is_read_only: bool, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waits = [self.writer] if self.writer and not self.writer.done() else []
+        if is_read_only:
+            self.readers.add(future)
+        else:
+            waits.extend(_ for _ in self.readers if not _.done())
+            self.writer, self.readers = future, set()
+        try:
+            with telemetry.span(f"wait {func.__name__}", read_only=is_read_only):
+                if waits:
+                    await asyncio.wait(waits)
+                await self.semaphore.acquire()
+            try:
+                if inspect.iscoroutinefunction(func):
+                    return await func(*args, **kwargs)
+                return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+            finally:
+                self.semaphore.release()
+        finally:
+            future.set_result(None)
+            self.readers.discard(future)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+class Workspace:
+
+    def __init__(self, location: str, name: str | None = None):
+        self.location = location
+        self.name = name
+        self.scheduler = ToolScheduler()
+        self.file_cache = FileCache()
+        self.workspace_index = WorkspaceIndex()
+        self.search_index = SearchIndex(self.workspace_index)
+        self.search_index.start(location)
+        self.session = BashSession(cwd=location)
+
+    def log(self, text: str):
+        print(f"\n{text}" if self.name is None else f"\033[90m[{self.name}]\033[0m {text}")
+
+    async def close(self):
+        await self.session.close()
+        self.scheduler.close()
+        self.file_cache.close()
 
 @agents.tool.function_tool
-def str_replace_editor(command: str, path: str, file_text: str | None = None, view_range: list[int] | None = None, old_str: str | None = None, new_str: str | None = None, insert_line: int | None = None):
+@ToolScheduler.tool(lambda command, *_, **__: command == "view")
+def str_replace_editor(ctx: agents.RunContextWrapper[Workspace], command: str, path: str, file_text: str | None = None, view_range: list[int] | None = None, old_str: str | None = None, new_str: str | None = None, insert_line: int | None = None):
     """
     Custom editing tool for viewing, creating and editing files
     * State is persistent across command calls and discussions with the user
-    * If `path` is a file, `view` displays the result of applying `cat -n`. If `path` is a directory, `view` lists non-hidden files and directories up to 2 levels deep
+    * If `path` is a file, `view` displays the result of applying `cat -n`. If `path` is a directory, `view` lists non-hidden files and directories up to 2 levels deep, skipping entries ignored by `.gitignore`
     * The `create` command cannot be used if the specified `path` already exists as a file
     * If a `command` generates a long output, it will be truncated and marked with `<response clipped>`
 
@@ -28,6 +573,7 @@ def str_replace_editor(command: str, path: str, file_text: str | None = None, vi
     * The `old_str` parameter should match EXACTLY one or more consecutive lines from the original file. Be mindful of whitespaces!
     * If the `old_str` parameter is not unique in the file, the replacement will not be performed. Make sure to include enough context in `old_str` to make it unique
     * The `new_str` parameter should contain the edited lines that should replace the `old_str`
+    * In files larger than 16 MB tabs are shown and matched as is, use the exact characters of the file in `old_str`
 
     Args:
     command (str): The commands to run. Allowed options are: `view`, `create`, `str_replace`, `insert`.
@@ -44,11 +590,11 @@ def str_replace_editor(command: str, path: str, file_text: str | None = None, vi
         content = "\n".join([f"{i + init_line:6}\t{line}" for i, line in enumerate(content.split("\n"))])
         return f"Here's the result of running `cat -n` on {file}:\n" + content + "\n"
 
-    location = os.getcwd()
-    if not os.path.commonpath([os.path.abspath(location), os.path.abspath(path)]):
-        raise ValueError(f"The path '{path}' is not within the directory '{location}'.")
+    location = ctx.context.location
     if not os.path.isabs(path):
         raise NotADirectoryError(f"The path '{path}' is not an absolute path, it should start with `/`.")
+    if os.path.commonpath([location, os.path.abspath(path)]) != location:
+        raise ValueError(f"The path '{path}' is not within the directory '{location}'.")
     if command != "create" and not os.path.exists(path):
         raise FileNotFoundError(f"The path '{path}' does not exist")
     if command == "create" and os.path.exists(path):
@@ -56,27 +602,20 @@ def str_replace_editor(command: str, path: str, file_text: str | None = None, vi
     if command != "view" and os.path.isdir(path):
         raise IsADirectoryError(f"The path '{path}' is a directory and only the `view` command can be used on directories")
     if command == "view":
-        print(f"\n\U0001F50D\033[32m > {command} {os.path.relpath(path, location)}{':'+(':'.join(str(_) for _ in view_range)) if view_range else ''}\033[0m")
+        ctx.context.log(f"\U0001F50D\033[32m > {command} {os.path.relpath(path, location)}{':'+(':'.join(str(_) for _ in view_range)) if view_range else ''}\033[0m")
         if os.path.isdir(path):
             if view_range:
                 raise ValueError("The `view_range` parameter is not allowed when `path` points to a directory.")
             result = []
-            for root, _, files in os.walk(path):
-                rel = os.path.relpath(root, path)
-                depth = 0 if rel == "." else rel.count(os.sep) + 1
-                if depth < 2 and (rel == '.' or not rel.startswith(".")):
-                    if rel != ".":
-                        result.append(os.path.join(".", rel, ""))
-                    for file in files:
-                        result.append(os.path.join(".", file) if rel == "." else os.path.join(".", rel, file))
+            for child, is_dir in ctx.context.workspace_index.walk(path, 2, location):
+                result.append(os.path.join(".", os.path.relpath(child, path), "") if is_dir else os.path.join(".", os.path.relpath(child, path)))
             return sorted(result)
-        content = read_file(path)
+        buffer = ctx.context.file_cache.read(path)
         first = 1
         if view_range:
             if len(view_range) != 2 or not all(isinstance(i, int) for i in view_range):
                 raise ValueError("Invalid `view_range`. It should be a list of two integers.")
-            lines = content.split("\n")
-            line_count = len(lines)
+            line_count = buffer.count
             first, last = view_range
             if first < 1 or first > line_count:
                 raise ValueError(f"Invalid `view_range`: {view_range}. Its first element `{first}` should be within the range of lines of the file: {[1, line_count]}")
@@ -84,50 +623,185 @@ def str_replace_editor(command: str, path: str, file_text: str | None = None, vi
                 raise ValueError(f"Invalid `view_range`: {view_range}. Its second element `{last}` should be smaller than the number of lines in the file: `{line_count}`")
             if last != -1 and last < first:
                 raise ValueError(f"Invalid `view_range`: {view_range}. Its second element `{last}` should be larger or equal than its first `{first}`")
-            content = "\n".join(lines[first - 1 :]) if last == -1 else "\n".join(lines[first - 1 : last])
-        return make_output(content, str(path), init_line=first)
-    print(f"\n\u270F\uFE0F\033[32m  > {command} {os.path.relpath(path, location)}\033[0m")
+            return make_output(buffer.lines(first - 1) if last == -1 else buffer.lines(first - 1, last), str(path), init_line=first, expand_tabs=False)
+        return make_output(buffer.lines(0), str(path), init_line=first, expand_tabs=False)
+    ctx.context.log(f"\u270F\uFE0F\033[32m  > {command} {os.path.relpath(path, location)}\033[0m")
     if command == "create":
         if file_text is None:
             raise ValueError("Parameter `file_text` required for command 'create'.")
         write_file(path, file_text)
+        ctx.context.search_index.invalidate(path)
         return f"File created successfully: '{path}'."
     if command == "str_replace":
         if old_str is None:
             raise ValueError("Parameter `old_str` required for command 'str_replace'.")
-        content = read_file(path).expandtabs()
-        old_str = old_str.expandtabs()
-        new_str = new_str.expandtabs() if new_str else ""
-        occurrences = content.count(old_str)
-        if occurrences == 0:
+        buffer = ctx.context.file_cache.read(path)
+        new_str = new_str or ""
+        if isinstance(buffer, FileBuffer):
+            old_str, new_str = old_str.expandtabs(), new_str.expandtabs()
+        occurrences = buffer.find(old_str, 2)
+        if len(occurrences) == 0:
             raise ValueError(f"No replacement was performed, old_str `{old_str}` did not appear verbatim in {path}")
-        if occurrences > 1:
-            raise ValueError(f"No replacement was performed. Multiple occurrences of old_str `{old_str}` in lines {[i + 1 for i, line in enumerate(content.splitlines()) if old_str in line]}. Please ensure it is unique.")
-        new_content = content.replace(old_str, new_str)
-        write_file(path, new_content)
-        replacement = content.split(old_str)[0].count("\n")
+        if len(occurrences) > 1:
+            raise ValueError(f"No replacement was performed. Multiple occurrences of old_str `{old_str}` in lines {sorted({buffer.line(_) + 1 for _ in buffer.find(old_str, 100)})}. Please ensure it is unique.")
+        index = occurrences[0]
+        replacement = buffer.line(index)
+        buffer.replace(index, index + buffer.length(old_str), new_str)
+        ctx.context.file_cache.write(path, buffer)
+        ctx.context.search_index.invalidate(path)
         start = max(0, replacement - 4)
         end = replacement + 4 + new_str.count("\n")
-        snippet = "\n".join(new_content.split("\n")[start : end + 1])
-        output = make_output(snippet, f"a snippet of {path}", start + 1)
+        output = make_output(buffer.lines(start, end + 1), f"a snippet of {path}", start + 1, expand_tabs=False)
         return f"The file {path} has been edited. {output}Review the changes and make sure they are as expected. Edit the file again if necessary."
     if command == "insert":
         if insert_line is None or new_str is None:
             raise ValueError("Parameters `insert_line` and `new_str` are required for command 'insert'.")
-        content = read_file(path).expandtabs()
-        new_str = new_str.expandtabs()
-        lines = content.split("\n")
-        if insert_line < 0 or insert_line > len(lines):
-            raise ValueError(f"Invalid `insert_line` parameter: {insert_line}. It should be within the range of lines of the file: {[0, len(lines)]}")
-        new_lines = new_str.split("\n")
-        snippet = "\n".join(lines[max(0, insert_line - 4) : insert_line] + new_lines + lines[insert_line : insert_line + 4])
-        write_file(path, "\n".join(lines[:insert_line] + new_lines + lines[insert_line:]))
-        output = make_output(snippet, "a snippet of the edited file", max(1, insert_line - 4 + 1))
+        buffer = ctx.context.file_cache.read(path)
+        new_str = new_str.expandtabs() if isinstance(buffer, FileBuffer) else new_str
+        if insert_line < 0 or insert_line > buffer.count:
+            raise ValueError(f"Invalid `insert_line` parameter: {insert_line}. It should be within the range of lines of the file: {[0, buffer.count]}")
+        if insert_line < buffer.count:
+            buffer.replace(buffer.offset(insert_line), buffer.offset(insert_line), new_str + "\n")
+        else:
+            buffer.replace(buffer.size, buffer.size, "\n" + new_str)
+        ctx.context.file_cache.write(path, buffer)
+        ctx.context.search_index.invalidate(path)
+        snippet = buffer.lines(max(0, insert_line - 4), insert_line + new_str.count("\n") + 5)
+        output = make_output(snippet, "a snippet of the edited file", max(1, insert_line - 4 + 1), expand_tabs=False)
         return f"The file {path} has been edited. {output}Review the changes and make sure they are as expected (correct indentation, no duplicate lines, etc). Edit the file again if necessary."
     raise ValueError(f'Unrecognized command {command}.')
 
 @agents.tool.function_tool
-def bash(command: str) -> str:
+@ToolScheduler.tool(lambda *_, **__: True)
+def search(ctx: agents.RunContextWrapper[Workspace], query: str, path: str, regex: bool = False, case_sensitive: bool = True, glob: str | None = None, context: int = 0, max_results: int = 100) -> str:
+    """
+    Search the contents of files in the repository using a prebuilt index
+    * Much faster than `grep -rn` through the bash tool, prefer it to find code in the repository
+    * Hidden files and files ignored by `.gitignore` are not searched
+    * Results are printed as `path:line:text`, context lines as `path-line-text`
+
+    Args:
+    query (str): The text to search for. A Python regular expression if `regex` is true, otherwise a literal string.
+    path (str): Absolute path to the file or directory to search in, e.g. `/repo` or `/repo/src`.
+    regex (bool): Optional, whether `query` is a regular expression. Defaults to false.
+    case_sensitive (bool): Optional, whether the search is case sensitive. Defaults to true.
+    glob (str): Optional glob pattern to filter the searched files by their path relative to the repository, e.g. `*.py` or `src/**/*.ts`.
+    context (int): Optional number of lines of context to show before and after each match. Defaults to 0.
+    max_results (int): Optional maximum number of matches to return. Defaults to 100.
+    """
+    location = ctx.context.location
+    ctx.context.log(f"\U0001F50E\033[32m > search {query} {os.path.relpath(path, location)}{' ' + glob if glob else ''}\033[0m")
+    if not os.path.isabs(path):
+        raise NotADirectoryError(f"The path '{path}' is not an absolute path, it should start with `/`.")
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"The path '{path}' does not exist")
+    pattern = re.compile(query if regex else re.escape(query), re.MULTILINE | (0 if case_sensitive else re.IGNORECASE))
+    result, count = [], 0
+    for file in ctx.context.search_index.search(SearchIndex.literals(query) if regex else [query], path, glob):
+        try:
+            buffer = ctx.context.file_cache.open(file, expand_tabs=False)
+        except (OSError, UnicodeDecodeError):
+            continue
+        try:
+            lines = sorted({buffer.line(match.start()) for match in itertools.islice(buffer.finditer(pattern), max_results - count)})
+            count += len(lines)
+            name, last = os.path.relpath(file, location), None
+            for line in lines:
+                first = max(0, line - context, last + 1 if last is not None else 0)
+                if context and last is not None and first > last + 1:
+                    result.append("--")
+                for i in range(first, min(buffer.count, line + context + 1)):
+                    result.append(f"{name}{':' if i == line else '-'}{i + 1}{':' if i == line else '-'}{buffer.lines(i, i + 1).expandtabs()}")
+                last = min(buffer.count, line + context + 1) - 1
+        finally:
+            if isinstance(buffer, MappedBuffer):
+                buffer.close()
+        if count >= max_results:
+            result.append(f"[Results truncated at {max_results} matches]")
+            break
+    return "\n".join(result) if result else "No matches found."
+
+class BashSession:
+
+    def __init__(self, timeout: float = 120, limit: int = 16000, cwd: str | None = None):
+        self.timeout = timeout
+        self.limit = limit
+        self.executable = shutil.which("bash") or "/bin/bash"
+        self.process = None
+        self.lock = None
+        self.cwd = cwd
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(self.executable, "--noprofile", "--norc", stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=self.cwd, start_new_session=True)
+
+    async def kill(self, process: asyncio.subprocess.Process):
+        if process.returncode is None:
+            if hasattr(os, "killpg"):
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            else:
+                process.kill()
+            await process.wait()
+
+    async def close(self):
+        if self.process:
+            await self.kill(self.process)
+        self.process = None
+
+    async def read(self, stream: asyncio.StreamReader, sentinel: bytes, output: bytearray) -> tuple[int, bytes]:
+        size, tail = 0, bytearray()
+        def append(data: bytes):
+            nonlocal size
+            output.extend(data[:max(0, self.limit - len(output))])
+            size += len(data)
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                raise EOFError("The shell session terminated unexpectedly.")
+            tail.extend(chunk)
+            index = tail.find(sentinel)
+            if index != -1:
+                end = tail.find(b"\n", index + len(sentinel))
+                if end != -1:
+                    append(tail[:index])
+                    return size, bytes(tail[index + len(sentinel) : end])
+            elif len(tail) > 4096:
+                append(tail[:-4096])
+                del tail[:-4096]
+
+    async def run(self, command: str, timeout: float | None = None) -> tuple[int | None, str, str]:
+        timeout = timeout or self.timeout
+        stdout, stderr = bytearray(), bytearray()
+        def clip(data: bytearray, size: int) -> str:
+            text = data.decode(errors="replace")
+            return text + f"<response clipped><NOTE>{size - len(data)} more bytes of output were discarded.</NOTE>" if size > len(data) else text
+        self.lock = self.lock or asyncio.Lock()
+        async with self.lock:
+            if self.process is None or self.process.returncode is not None:
+                await self.start()
+            marker = f"__bash_session_{uuid.uuid4().hex}__"
+            script = f"IFS= read -r -d '' __command <<'{marker}'\n{command}\n{marker}\neval \"$__command\" < /dev/null\n__status=$?\nprintf '\\n{marker}%d %s\\n' $__status \"$PWD\"\nprintf '\\n{marker}\\n' >&2\n"
+            self.process.stdin.write(script.encode())
+            await self.process.stdin.drain()
+            sentinel = f"\n{marker}".encode()
+            try:
+                (stdout_size, trailer), (stderr_size, _) = await asyncio.wait_for(asyncio.gather(self.read(self.process.stdout, sentinel, stdout), self.read(self.process.stderr, sentinel, stderr)), timeout)
+            except asyncio.TimeoutError:
+                await self.close()
+                return None, stdout.decode(errors="replace"), stderr.decode(errors="replace") + f"\nCommand timed out after {timeout} seconds. The shell session was restarted, environment variables were reset."
+            except EOFError:
+                status = await self.process.wait()
+                await self.close()
+                return status, stdout.decode(errors="replace"), stderr.decode(errors="replace") + "\nThe shell session exited and was restarted, environment variables were reset."
+            status, _, cwd = trailer.decode(errors="replace").partition(" ")
+            self.cwd = cwd or self.cwd
+            return int(status), clip(stdout, stdout_size), clip(stderr, stderr_size)
+
+@agents.tool.function_tool
+@ToolScheduler.tool(lambda command, *_, **__: read_only(command))
+async def bash(ctx: agents.RunContextWrapper[Workspace], command: str, timeout: int | None = None) -> str:
     """
     Run commands in a bash shell
     When invoking this tool, the contents of the "command" parameter does NOT need to be XML-escaped.
@@ -137,86 +811,257 @@ def bash(command: str) -> str:
     To inspect a particular line range of a file, e.g. lines 10-25, try 'sed -n 10,25p /path/to/the/file'.
     Please avoid commands that may produce a very large amount of output.
     Please run long lived commands in the background, e.g. 'sleep 10 &' or start a server in the background.
+    Commands that exceed the timeout are killed and the shell session is restarted.
 
     Args:
     command (str): The bash command to run.
+    timeout (int): Optional timeout in seconds for the command, defaults to 120 seconds.
     """
-    print(f"\n\U0001F5A5\033[32m  > {command}\033[0m")
-    return subprocess.run(command, shell=True, capture_output=True, text=True, check=True).stdout
+    ctx.context.log(f"\U0001F5A5\033[32m  > {command}\033[0m")
+    ctx.context.search_index.dirty = ctx.context.search_index.dirty or not read_only(command)
+    status, stdout, stderr = await ctx.context.session.run(command, timeout)
+    if status == 0 and not stderr:
+        return stdout
+    return "\n".join(_ for _ in [f"Exit code {status}" if status else None, stdout, f"<stderr>\n{stderr}</stderr>" if stderr else None] if _)
 
-@agents.tool.function_tool
-def apply_patch(patch_text: str) -> str:
-    print("\n\U0001F4DD\033[32m  > apply_patch\033[0m")
-    def write_lines(path: str, content: list) -> None:
-        if "/" in path:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-        write_file(path, "\n".join(content))
-    lines = patch_text.strip().split("\n")
-    if not lines or not lines[0].startswith("*** Begin Patch"):
-        return "Error: Patch must start with '*** Begin Patch'"
-    i = 1
-    while i < len(lines) and not lines[i].startswith("*** End Patch"):
-        cmd, i = lines[i], i + 1
-        if cmd.startswith("*** Add File: "):
-            path, content = cmd[14:], []
-            while i < len(lines) and not lines[i].startswith("***"):
-                content.append(lines[i][1:] if lines[i].startswith("+") else lines[i])
+class Patch:
+
+    normalizers = [lambda line: line, str.rstrip, lambda line: " ".join(line.split())]
+
+    def __init__(self, patch_text: str, root: str = ""):
+        lines = patch_text.strip().split("\n")
+        if not lines or not lines[0].startswith("*** Begin Patch"):
+            raise ValueError("Patch must start with '*** Begin Patch'")
+        self.operations = []
+        i = 1
+        while i < len(lines) and not lines[i].startswith("*** End Patch"):
+            cmd, i = lines[i], i + 1
+            body, target = [], None
+            while i < len(lines) and (not lines[i].startswith("***") or lines[i].startswith(("*** End of File", "*** Move to: "))):
+                if lines[i].startswith("*** Move to: "):
+                    target = lines[i][13:]
+                elif not lines[i].startswith("***"):
+                    body.append(lines[i])
                 i += 1
-            if os.path.exists(path):
-                raise FileExistsError(f"Cannot add file '{path}': file already exists")
-            write_lines(path, content)
-        elif cmd.startswith("*** Delete File: "):
-            os.remove(cmd[17:])
-        elif cmd.startswith("*** Update File: "):
-            file_lines = read_file(cmd[17:]).split("\n")
-            idx, result = 0, []
-            while i < len(lines) and not lines[i].startswith("***"):
-                patch_line, i = lines[i], i + 1
-                if not patch_line:
-                    continue
-                if patch_line.startswith("@@ "):
-                    found = next((j for j, line in enumerate(file_lines[idx:], idx) if line == patch_line[3:]), idx)
-                    result.extend(file_lines[idx:found])
-                    idx = found
-                elif patch_line[0] in " -":
-                    content = patch_line[1:]
-                    if idx >= len(file_lines) or file_lines[idx] != content:
-                        raise ValueError(f"{'Context' if patch_line[0] == ' ' else 'Deletion'} mismatch at {idx}: expected {repr(content)}, found {repr(file_lines[idx] if idx < len(file_lines) else 'EOF')}")
-                    result.append(file_lines[idx]) if patch_line[0] == " " else None
+            if cmd.startswith("*** Add File: "):
+                self.operations.append(("add", os.path.join(root, cmd[14:]), [line[1:] if line.startswith("+") else line for line in body]))
+            elif cmd.startswith("*** Delete File: "):
+                self.operations.append(("delete", os.path.join(root, cmd[17:]), None))
+            elif cmd.startswith("*** Update File: ") and target:
+                self.operations.append(("delete", os.path.join(root, cmd[17:]), None))
+                self.operations.append(("move", os.path.join(root, target), (os.path.join(root, cmd[17:]), self.hunks(body))))
+            elif cmd.startswith("*** Update File: "):
+                self.operations.append(("update", os.path.join(root, cmd[17:]), self.hunks(body)))
+
+    @staticmethod
+    def hunks(body: list[str]) -> list[tuple[str | None, list[tuple[str, str]]]]:
+        hunks = [(None, [])]
+        for line in body:
+            if line.startswith("@@"):
+                hunks.append((line[3:] if line.startswith("@@ ") else None, []))
+            elif not line or line[0] in " -+":
+                hunks[-1][1].append((line[0] if line else " ", line[1:]))
+        for _, changes in hunks:
+            while changes and changes[-1] == (" ", ""):
+                changes.pop()
+        return [hunk for hunk in hunks if hunk[0] is not None or hunk[1]]
+
+    @classmethod
+    def update(cls, path: str, file_lines: list[str], hunks: list) -> list[str]:
+        indices = {}
+        def locate(block: list[str], start: int) -> int | None:
+            for level, normalize in enumerate(cls.normalizers):
+                if level not in indices:
+                    lines = [normalize(line) for line in file_lines]
+                    index = {}
+                    for i, line in enumerate(lines):
+                        index.setdefault(line, []).append(i)
+                    indices[level] = (lines, index)
+                lines, index = indices[level]
+                key = [normalize(line) for line in block]
+                candidates = index.get(key[0], [])
+                for i in candidates[bisect.bisect_left(candidates, start):]:
+                    if lines[i : i + len(key)] == key:
+                        return i
+            return None
+        idx, result = 0, []
+        for anchor, changes in hunks:
+            start = idx
+            if anchor is not None:
+                found = locate([anchor], idx)
+                start = idx if found is None else found
+            block = [text for op, text in changes if op in " -"]
+            found = locate(block, start) if block else start
+            if found is None:
+                raise ValueError(f"Context mismatch in '{path}': could not find {repr(block[0])} and the following {len(block) - 1} line(s) after line {start + 1}")
+            result.extend(file_lines[idx:found])
+            idx = found
+            for op, text in changes:
+                if op == "+":
+                    result.append(text)
+                else:
+                    result.append(file_lines[idx]) if op == " " else None
                     idx += 1
-                elif patch_line[0] == "+":
-                    result.append(patch_line[1:])
-            result.extend(file_lines[idx:])
-            write_lines(cmd[17:], result)
+        result.extend(file_lines[idx:])
+        return result
+
+    def prepare(self, path: str, operations: list) -> tuple[str | None, str | None]:
+        original = read_file(path) if os.path.isfile(path) else None
+        content = original
+        for command, _, body in operations:
+            if command == "add":
+                if content is not None:
+                    raise FileExistsError(f"Cannot add file '{path}': file already exists")
+                content = "\n".join(body)
+            elif command == "move":
+                source, hunks = body
+                if content is not None:
+                    raise FileExistsError(f"Cannot move file '{source}' to '{path}': file already exists")
+                if not os.path.isfile(source):
+                    raise FileNotFoundError(f"Cannot move file '{source}': file does not exist")
+                content = "\n".join(self.update(source, read_file(source).split("\n"), hunks))
+            elif content is None:
+                raise FileNotFoundError(f"Cannot {command} file '{path}': file does not exist")
+            elif command == "delete":
+                content = None
+            else:
+                content = "\n".join(self.update(path, content.split("\n"), body))
+        return original, content
+
+    async def apply(self) -> list[str]:
+        groups = {}
+        for operation in self.operations:
+            groups.setdefault(operation[1], []).append(operation)
+        paths = list(groups)
+        results = await asyncio.gather(*(asyncio.to_thread(self.prepare, path, groups[path]) for path in paths), return_exceptions=True)
+        errors = [str(_) for _ in results if isinstance(_, BaseException)]
+        if errors:
+            raise ValueError("\n".join(errors) + "\nThe patch was not applied, no files were modified.")
+        def stage(path: str, content: str | None) -> str | None:
+            if content is None:
+                return None
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            return stage_file(os.path.realpath(path), content)
+        temps = await asyncio.gather(*(asyncio.to_thread(stage, path, content) for path, (_, content) in zip(paths, results)), return_exceptions=True)
+        if any(isinstance(_, BaseException) for _ in temps):
+            for temp in temps:
+                if isinstance(temp, str):
+                    os.remove(temp)
+            raise next(_ for _ in temps if isinstance(_, BaseException))
+        done = []
+        try:
+            for path, temp in zip(paths, temps):
+                os.replace(temp, os.path.realpath(path)) if temp else os.remove(path)
+                done.append(path)
+        except BaseException:
+            for path, (original, _) in zip(paths, results):
+                if path in done:
+                    write_file(path, original) if original is not None else os.remove(path)
+            for temp in temps[len(done):]:
+                if temp and os.path.exists(temp):
+                    os.remove(temp)
+            raise
+        return paths
+
+@agents.tool.function_tool
+@ToolScheduler.tool(lambda *_, **__: False)
+async def apply_patch(ctx: agents.RunContextWrapper[Workspace], patch_text: str) -> str:
+    ctx.context.log("\U0001F4DD\033[32m  > apply_patch\033[0m")
+    try:
+        patch = Patch(patch_text, ctx.context.location)
+    except ValueError as error:
+        return f"Error: {error}"
+    try:
+        paths = await patch.apply()
+    except (ValueError, OSError) as error:
+        return f"Error: {error}"
+    for path in paths:
+        ctx.context.search_index.invalidate(path)
     return "Patch applied successfully"
 
 @agents.tool.function_tool
-def shell(command: list[str], workdir: str) -> str:
-    print(f"\n\U0001F5A5\033[32m  > shell {' '.join(command)} (in {workdir})\033[0m")
-    result = subprocess.run(command, cwd=workdir, capture_output=True, text=True, check=False)
+@ToolScheduler.tool(lambda command, *_, **__: read_only(command))
+def shell(ctx: agents.RunContextWrapper[Workspace], command: list[str], workdir: str) -> str:
+    ctx.context.log(f"\U0001F5A5\033[32m  > shell {' '.join(command)} (in {workdir})\033[0m")
+    ctx.context.search_index.dirty = ctx.context.search_index.dirty or not read_only(command)
+    result = subprocess.run(command, cwd=os.path.join(ctx.context.location, workdir), capture_output=True, text=True, check=False)
     return result.stdout if result.returncode == 0 else f"Exit code {result.returncode}\n{result.stderr}"
 
-async def main():
-    argv = list(sys.argv[1:])
-    model = argv.pop(0) if len(argv) > 0 and argv[0] in ('gpt', 'claude', 'gemini') else 'claude'
-    if len(argv) < 1 or not os.path.exists(argv[0]):
-        print("Usage: python code.py [gpt|claude|gemini] <directory> [prompt]")
-        sys.exit(1)
-    location = os.path.abspath(argv.pop(0))
-    os.chdir(location)
-    prompt = argv.pop(0) if len(argv) > 0 else None
+class History:
+
+    def __init__(self, path: str | None, budget: int = 100000):
+        self.path = path
+        self.budget = budget
+        self.items = []
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.items = [json.loads(line) for line in f if line.strip()]
+        self.items = self.compact()
+        self.save(self.items, "w")
+
+    def save(self, items: list, mode: str = "a"):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, mode, encoding="utf-8") as f:
+            f.writelines(json.dumps(item, separators=(",", ":")) + "\n" for item in items)
+
+    def append(self, items: list):
+        self.items.extend(items)
+        self.save(items)
+
+    def compact(self, items: list | None = None) -> list:
+        items = [dict(item) for item in (self.items if items is None else items)]
+        calls = {item["call_id"]: item for item in items if item.get("type") == "function_call"}
+        outputs = [item for item in items if item.get("type") == "function_call_output" and isinstance(item.get("output"), str)]
+        views = set()
+        for item in reversed(outputs):
+            call = calls.get(item["call_id"])
+            if call and call.get("name") == "str_replace_editor":
+                try:
+                    args = json.loads(call.get("arguments") or "{}")
+                except json.JSONDecodeError:
+                    continue
+                if args.get("command") == "view":
+                    key = (args.get("path"), str(args.get("view_range")))
+                    if key in views:
+                        item["output"] = f"[Output omitted, a later view of {args.get('path')} supersedes it]"
+                    views.add(key)
+        total = sum(len(json.dumps(item)) // 4 for item in items)
+        for keep in (500, 0):
+            for item in outputs:
+                if total <= self.budget:
+                    return items
+                output = item["output"]
+                if len(output) > 4 * keep + 200:
+                    item["output"] = f"{output[:keep]}\n[... {len(output) - 2 * keep} characters omitted ...]\n{output[len(output) - keep:]}"
+                    total -= (len(output) - len(item["output"])) // 4
+        sizes = [len(json.dumps(item)) // 4 for item in items]
+        total, start = sum(sizes), 0
+        for turn in [i for i, item in enumerate(items) if item.get("role") == "user"][1:]:
+            if total <= self.budget:
+                break
+            total -= sum(sizes[start:turn])
+            start = turn
+        return items[start:]
+
+    def filter(self, data: agents.run.CallModelData) -> agents.run.ModelInputData:
+        return agents.run.ModelInputData(input=self.compact(data.model_data.input), instructions=data.model_data.instructions)
+
+def create_agent(model: str, location: str) -> agents.Agent:
     model_settings = agents.ModelSettings(truncation="auto")
     if model == 'gpt':
         model = 'gpt-5.4'
         model_settings.reasoning = {"effort": "medium"}
-        tools = [apply_patch, shell, agents.WebSearchTool()]
+        tools = [apply_patch, shell, search, agents.WebSearchTool()]
     elif model == 'claude':
-        tools = [str_replace_editor, bash]
-        client = openai.AsyncOpenAI(api_key=os.getenv("ANTHROPIC_API_KEY"), base_url="https://api.anthropic.com/v1/")
+        tools = [str_replace_editor, search, bash]
+        client = openai.AsyncOpenAI(api_key=os.getenv("ANTHROPIC_API_KEY"), base_url=os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com/v1/"))
         model = agents.OpenAIChatCompletionsModel("claude-opus-4-6", client)
     elif model == 'gemini':
-        tools = [str_replace_editor, bash]
-        client = openai.AsyncOpenAI(api_key=os.getenv('GEMINI_API_KEY'), base_url='https://generativelanguage.googleapis.com/v1beta/')
+        tools = [str_replace_editor, search, bash]
+        client = openai.AsyncOpenAI(api_key=os.getenv('GEMINI_API_KEY'), base_url=os.getenv('GEMINI_BASE_URL', 'https://generativelanguage.googleapis.com/v1beta/'))
         model = agents.OpenAIChatCompletionsModel("gemini-2.5-pro", client)
     instructions = f"""
 The code repository is in this directory: <location>{location}</location>
@@ -229,21 +1074,135 @@ Follow these steps:
 
 Your thinking should be thorough and so it's fine if it's very long.
 """
-    agent = agents.Agent("code", instructions=instructions, model=model, model_settings=model_settings, tools=tools)
-    messages = []
-    while True:
-        user_request = input("\U0001F464 User: ") if not prompt else prompt
-        print("\U0001F916 ", end="", flush=True)
-        messages.append({"role": "user", "content": user_request})
-        stream = agents.Runner.run_streamed(agent, messages, max_turns=100)
-        response = ""
-        async for event in stream.stream_events():
-            if event.type == 'raw_response_event' and event.data.type == "response.output_text.delta":
-                response += event.data.delta
-                print(event.data.delta, end="", flush=True)
-        messages.append({"role": "assistant", "content": response})
-        print("")
-        if prompt:
-            break
+    return agents.Agent("code", instructions=instructions, model=model, model_settings=model_settings, tools=tools)
+
+async def git(*args: str, cwd: str) -> str:
+    process = await asyncio.create_subprocess_exec("git", *args, cwd=cwd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    if process.returncode:
+        raise RuntimeError(f"git {args[0]} failed: {stderr.decode(errors='replace').strip()}")
+    return stdout.decode(errors="replace")
+
+class Worktree:
+
+    def __init__(self, repo: str, path: str, keep: bool = False):
+        self.repo = os.path.abspath(repo)
+        self.path = path
+        self.keep = keep
+        self.location = path
+        self.linked = False
+
+    async def __aenter__(self):
+        try:
+            root = (await git("rev-parse", "--show-toplevel", cwd=self.repo)).strip()
+        except RuntimeError:
+            root = None
+        if root:
+            await git("worktree", "add", "--detach", self.path, "HEAD", cwd=root)
+            self.linked = True
+            self.location = os.path.normpath(os.path.join(self.path, os.path.relpath(self.repo, root)))
+        else:
+            await asyncio.to_thread(shutil.copytree, self.repo, self.path, symlinks=True)
+            await git("init", "-q", cwd=self.path)
+            await git("add", "-A", cwd=self.path)
+            await git("-c", "user.name=code", "-c", "user.email=code@localhost", "commit", "-q", "--no-verify", "--allow-empty", "-m", "base", cwd=self.path)
+        return self
+
+    async def diff(self) -> str:
+        await git("add", "-A", cwd=self.path)
+        return await git("diff", "--cached", "--binary", "HEAD", cwd=self.path)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self.keep:
+            return
+        await asyncio.to_thread(shutil.rmtree, self.path, ignore_errors=True)
+        if self.linked:
+            await git("worktree", "prune", cwd=self.repo)
+
+async def run_task(model: str, task: dict, path: str, timeout: float | None, keep: bool) -> dict:
+    result = {"id": task["id"], "repo": task["repo"], "status": "failed", "output": None, "error": None, "diff": "", "duration": 0.0}
+    start = time.monotonic()
+    try:
+        async with Worktree(task["repo"], path, keep) as worktree:
+            workspace = Workspace(worktree.location, task["id"])
+            try:
+                run_config = agents.RunConfig(call_model_input_filter=History(None).filter)
+                run = agents.Runner.run(create_agent(model, worktree.location), [{"role": "user", "content": task["prompt"]}], context=workspace, max_turns=100, run_config=run_config)
+                output = await asyncio.wait_for(run, timeout)
+                result.update(status="completed", output=str(output.final_output))
+            except asyncio.TimeoutError:
+                result.update(status="timeout", error=f"Task timed out after {timeout} seconds.")
+            except Exception as error:
+                result.update(error=f"{type(error).__name__}: {error}")
+            finally:
+                await workspace.close()
+            result["diff"] = await worktree.diff()
+            if keep:
+                result["workspace"] = worktree.location
+    except Exception as error:
+        result["error"] = result["error"] or f"{type(error).__name__}: {error}"
+    result["duration"] = round(time.monotonic() - start, 3)
+    return result
+
+async def batch(model: str, file: str, output: str, jobs: int, timeout: float | None, keep: bool):
+    with open(file, encoding="utf-8") as f:
+        tasks = [json.loads(line) for line in f if line.strip()]
+    for i, task in enumerate(tasks):
+        task["id"] = str(task.get("id") or i + 1)
+    directory = tempfile.mkdtemp(prefix="code-batch-")
+    semaphore = asyncio.Semaphore(jobs)
+    async def worker(task: dict) -> dict:
+        async with semaphore:
+            print(f"\033[90m[{task['id']}]\033[0m \U0001F916 {task['repo']}: {task['prompt'][:80]}")
+            return await run_task(model, task, os.path.join(directory, re.sub(r"[^\w.-]", "_", task["id"])), timeout, keep)
+    counts = {}
+    with open(output, "w", encoding="utf-8") as f:
+        for future in asyncio.as_completed([worker(task) for task in tasks]):
+            result = await future
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+            files = sum(1 for line in result["diff"].splitlines() if line.startswith("diff --git"))
+            mark = "\u2714" if result["status"] == "completed" else "\u2718"
+            print(f"\033[90m[{result['id']}]\033[0m {mark} {result['status']}, {files} files changed, {result['duration']:.1f}s{' ' + result['error'] if result['error'] else ''}")
+    if not keep:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"{len(tasks)} tasks: {', '.join(f'{count} {status}' for status, count in counts.items())}. Results written to {output}")
+
+async def main():
+    options = dict(_[2:].partition("=")[::2] for _ in sys.argv[1:] if _.startswith("--"))
+    argv = [_ for _ in sys.argv[1:] if not _.startswith("--")]
+    model = argv.pop(0) if len(argv) > 0 and argv[0] in ('gpt', 'claude', 'gemini') else 'claude'
+    if options.get("batch"):
+        timeout = float(options["timeout"]) if options.get("timeout") else None
+        with telemetry.session(options.get("telemetry"), "code"):
+            await batch(model, options["batch"], options.get("output") or "results.jsonl", int(options.get("jobs") or 4), timeout, "keep" in options)
+        return
+    if len(argv) < 1 or not os.path.exists(argv[0]):
+        print("Usage: python code.py [gpt|claude|gemini] [--resume] [--budget=<tokens>] [--telemetry=<spans.jsonl>] <directory> [prompt]")
+        print("       python code.py [gpt|claude|gemini] --batch=<tasks.jsonl> [--output=<results.jsonl>] [--jobs=<n>] [--timeout=<seconds>] [--keep] [--telemetry=<spans.jsonl>]")
+        sys.exit(1)
+    location = os.path.abspath(argv.pop(0))
+    workspace = Workspace(location)
+    prompt = argv.pop(0) if len(argv) > 0 else None
+    agent = create_agent(model, location)
+    name = hashlib.sha1(location.encode()).hexdigest()[:16]
+    history = History(os.path.join(os.path.expanduser("~"), ".cache", "agents", "code", f"{name}.jsonl"), int(options.get("budget") or 100000))
+    history.load() if "resume" in options else history.save([], "w")
+    with telemetry.session(options.get("telemetry"), "code"):
+        while True:
+            user_request = input("\U0001F464 User: ") if not prompt else prompt
+            print("\U0001F916 ", end="", flush=True)
+            history.append([{"role": "user", "content": user_request}])
+            stream = agents.Runner.run_streamed(agent, history.compact(), context=workspace, max_turns=100, run_config=agents.RunConfig(call_model_input_filter=history.filter))
+            async for event in stream.stream_events():
+                if event.type == 'raw_response_event' and event.data.type == "response.output_text.delta":
+                    print(event.data.delta, end="", flush=True)
+            history.append([item.to_input_item() for item in stream.new_items])
+            print("")
+            if prompt:
+                break
+    await workspace.close()
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,17 +1,159 @@
 import asyncio
 import base64
+import concurrent.futures
+import contextlib
+import functools
 import io
+import os
 import platform
+import shutil
+import subprocess
+import sys
+import time
+import zlib
 
 import agents
-import pyautogui
+import PIL.Image
+import PIL.ImageGrab
 
+import telemetry
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+try:
+    import pyautogui
+except Exception:
+    pyautogui = None
+
+
+class XDoTool:
+
+    buttons = {"left": 1, "middle": 2, "right": 3, "back": 8, "forward": 9}
+    keys = {
+        "enter": "Return", "return": "Return", "esc": "Escape", "escape": "Escape",
+        "backspace": "BackSpace", "tab": "Tab", "space": "space", "delete": "Delete",
+        "up": "Up", "down": "Down", "left": "Left", "right": "Right",
+        "home": "Home", "end": "End", "pageup": "Prior", "pagedown": "Next",
+        "cmd": "super", "win": "super", "meta": "super", "option": "alt",
+    }
+
+    def __init__(self, display: str):
+        self.display = display
+        self.env = os.environ | {"DISPLAY": display}
+
+    def xdotool(self, *args) -> str:
+        return subprocess.run(["xdotool", *map(str, args)], env=self.env, capture_output=True, text=True, check=True).stdout
+
+    def key(self, key: str) -> str:
+        return self.keys.get(key, key.upper() if len(key) > 1 and key[0] == "f" and key[1:].isdigit() else key)
+
+    def size(self) -> tuple[int, int]:
+        width, height = self.xdotool("getdisplaygeometry").split()
+        return int(width), int(height)
+
+    def screenshot(self) -> PIL.Image.Image:
+        return PIL.ImageGrab.grab(xdisplay=self.display)
+
+    def moveTo(self, x: int, y: int, duration: float = 0):
+        self.xdotool("mousemove", x, y)
+
+    def click(self, x: int, y: int, button: str = "left"):
+        self.xdotool("mousemove", x, y, "click", self.buttons[button])
+
+    def doubleClick(self, x: int, y: int):
+        self.xdotool("mousemove", x, y, "click", "--repeat", 2, 1)
+
+    def scroll(self, clicks: int, x: int, y: int):
+        if clicks:
+            self.xdotool("mousemove", x, y, "click", "--repeat", abs(clicks), 4 if clicks > 0 else 5)
+
+    def hscroll(self, clicks: int, x: int, y: int):
+        if clicks:
+            self.xdotool("mousemove", x, y, "click", "--repeat", abs(clicks), 7 if clicks > 0 else 6)
+
+    def write(self, text: str):
+        self.xdotool("type", "--delay", 0, "--", text)
+
+    def keyDown(self, key: str):
+        self.xdotool("keydown", self.key(key))
+
+    def keyUp(self, key: str):
+        self.xdotool("keyup", self.key(key))
+
+    def mouseDown(self, button: str = "left"):
+        self.xdotool("mousedown", self.buttons[button])
+
+    def mouseUp(self, button: str = "left"):
+        self.xdotool("mouseup", self.buttons[button])
+
+    def dragTo(self, x: int, y: int, duration: float = 0, button: str = "left"):
+        self.xdotool("mousedown", self.buttons[button], "mousemove", x, y, "mouseup", self.buttons[button])
 
 class LocalComputer(agents.AsyncComputer):
 
-    def __init__(self):
-        screenshot = pyautogui.screenshot()
-        self.size = screenshot.size
+    def __init__(self, resolution: tuple[int, int] | None = (1440, 900), fast: bool = False, interval: float = 0.1, display: str | None = None, input=None):
+        self.display = display
+        self.input = input or (XDoTool(display) if display else pyautogui)
+        self.mss = mss if input is None else None
+        self.fast = fast
+        self.interval = interval
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="computer")
+        self.capture = None
+        self.buffer = io.BytesIO()
+        self.digest = None
+        self.encoded = None
+        if fast and self.input is pyautogui:
+            pyautogui.PAUSE = 0.01
+        self.screen = tuple(self.input.size())
+        width, height = self.executor.submit(self.grab).result()[1].size
+        scale = min(1, resolution[0] / width, resolution[1] / height) if resolution else 1
+        self.size = (round(width * scale), round(height * scale))
+
+    async def run(self, func, *args, **kwargs):
+        if not telemetry.enabled:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        with telemetry.span(f"computer {func.__name__}") as data:
+            queued = time.perf_counter()
+            def call():
+                data["queue_wait_ms"] = round((time.perf_counter() - queued) * 1000, 3)
+                return func(*args, **kwargs)
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+            data["bytes_out"] = len(result) if isinstance(result, str) else 0
+            return result
+
+    def grab(self, image: bool = True) -> tuple[int, PIL.Image.Image | None]:
+        if self.mss and self.capture is None:
+            self.capture = self.mss.mss(display=self.display) if self.display else self.mss.mss()
+        if self.capture:
+            shot = self.capture.grab(self.capture.monitors[1])
+            return zlib.crc32(shot.raw), PIL.Image.frombytes("RGB", shot.size, shot.raw, "raw", "BGRX") if image else None
+        screenshot = self.input.screenshot()
+        return zlib.crc32(screenshot.tobytes()), screenshot
+
+    def encode(self) -> str:
+        digest, image = self.grab()
+        if digest != self.digest:
+            if image.size != self.size:
+                image = image.resize(self.size, PIL.Image.Resampling.BILINEAR, reducing_gap=2.0)
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            image.save(self.buffer, format="PNG", compress_level=1)
+            self.digest = digest
+            self.encoded = base64.b64encode(self.buffer.getbuffer()).decode("utf-8")
+        return self.encoded
+
+    def close(self):
+        self.executor.submit(self.capture.close if self.capture else lambda: None).result()
+        self.executor.shutdown()
+
+    def point(self, x: int, y: int) -> tuple[int, int]:
+        return round(x * self.screen[0] / self.size[0]), round(y * self.screen[1] / self.size[1])
+
+    def tween(self, x: int, y: int, duration: float):
+        self.input.moveTo(x, y, duration=0 if self.fast else duration)
 
     @property
     def environment(self) -> agents.Environment:
@@ -23,33 +165,48 @@ class LocalComputer(agents.AsyncComputer):
         return self.size
 
     async def screenshot(self) -> str:
-        buffer = io.BytesIO()
-        pyautogui.screenshot().save(buffer, format="PNG")
-        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+        return await self.run(self.encode)
 
     async def click(self, x: int, y: int, button: str = "left") -> None:
         if 0 <= x < self.size[0] and 0 <= y < self.size[1]:
             button = "middle" if button == "wheel" else button
-            pyautogui.moveTo(x, y, duration=0.1)
-            pyautogui.click(x, y, button=button)
+            x, y = self.point(x, y)
+            def click():
+                self.tween(x, y, 0.1)
+                self.input.click(x, y, button=button)
+            await self.run(click)
 
     async def double_click(self, x: int, y: int) -> None:
         if 0 <= x < self.size[0] and 0 <= y < self.size[1]:
-            pyautogui.moveTo(x, y, duration=0.1)
-            pyautogui.doubleClick(x, y)
+            x, y = self.point(x, y)
+            def double_click():
+                self.tween(x, y, 0.1)
+                self.input.doubleClick(x, y)
+            await self.run(double_click)
 
     async def scroll(self, x: int, y: int, scroll_x: int, scroll_y: int) -> None:
-        pyautogui.scroll(-scroll_y, x=x, y=y)
-        pyautogui.hscroll(scroll_x, x=x, y=y)
+        x, y = self.point(x, y)
+        def scroll():
+            self.input.scroll(-scroll_y, x=x, y=y)
+            self.input.hscroll(scroll_x, x=x, y=y)
+        await self.run(scroll)
 
     async def type(self, text: str) -> None:
-        pyautogui.write(text)
+        await self.run(self.input.write, text)
 
     async def wait(self, ms: int = 1000) -> None:
-        await asyncio.sleep(ms / 1000)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ms / 1000
+        previous = None
+        while loop.time() < deadline:
+            digest, _ = await self.run(self.grab, False)
+            if digest == previous:
+                break
+            previous = digest
+            await asyncio.sleep(max(0, min(self.interval, deadline - loop.time())))
 
     async def move(self, x: int, y: int) -> None:
-        pyautogui.moveTo(x, y, duration=0.1)
+        await self.run(self.tween, *self.point(x, y), 0.1)
 
     async def keypress(self, keys: list[str]) -> None:
         keymap = {
@@ -57,40 +214,170 @@ class LocalComputer(agents.AsyncComputer):
             "arrowright": "right", "arrowup": "up",
         }
         keys = [keymap.get(key.lower(), key.lower()) for key in keys]
-        for key in keys:
-            pyautogui.keyDown(key)
-        for key in keys:
-            pyautogui.keyUp(key)
+        def keypress():
+            for key in keys:
+                self.input.keyDown(key)
+            for key in keys:
+                self.input.keyUp(key)
+        await self.run(keypress)
 
     async def drag(self, path: list[tuple[int, int]]) -> None:
         if len(path) >= 2:
-            pyautogui.moveTo(path[0][0], path[0][1], duration=0.5)
-            for point in path[1:]:
-                pyautogui.dragTo(point[0], point[1], duration=1.0, button="left")
+            path = [self.point(x, y) for x, y in path]
+            def drag():
+                if self.fast:
+                    self.input.moveTo(path[0][0], path[0][1])
+                    self.input.mouseDown(button="left")
+                    for point in path[1:]:
+                        self.input.moveTo(point[0], point[1])
+                    self.input.mouseUp(button="left")
+                else:
+                    self.input.moveTo(path[0][0], path[0][1], duration=0.5)
+                    for point in path[1:]:
+                        self.input.dragTo(point[0], point[1], duration=1.0, button="left")
+            await self.run(drag)
 
-async def main():
-    agent = agents.Agent(
+class DisplayPool:
+
+    def __init__(self, size: int, resolution: tuple[int, int] = (1440, 900), command: list[str] | None = None):
+        self.size = size
+        self.resolution = resolution
+        self.command = command
+        self.processes = {}
+        self.computers = asyncio.Queue()
+        self.closing = False
+
+    async def launch(self) -> LocalComputer:
+        read, write = os.pipe()
+        processes = []
+        try:
+            processes.append(await asyncio.create_subprocess_exec("Xvfb", "-displayfd", str(write), "-screen", "0", f"{self.resolution[0]}x{self.resolution[1]}x24", "-nolisten", "tcp", stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL, pass_fds=(write,), start_new_session=True))
+            os.close(write)
+            write = None
+            number = await asyncio.wait_for(asyncio.to_thread(os.read, read, 16), 10)
+            if not number.strip():
+                raise RuntimeError("Xvfb failed to start.")
+            display = f":{number.decode().strip()}"
+            env = os.environ | {"DISPLAY": display}
+            manager = next((_ for _ in ("openbox", "fluxbox", "matchbox-window-manager", "twm") if shutil.which(_)), None)
+            for command in ([manager] if manager else []) + ([self.command] if self.command else []):
+                processes.append(await asyncio.create_subprocess_exec(*command, env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL, start_new_session=True))
+            computer = await asyncio.to_thread(LocalComputer, self.resolution, fast=True, display=display)
+        except BaseException:
+            await self.terminate(processes)
+            raise
+        finally:
+            os.close(read)
+            if write is not None:
+                os.close(write)
+        self.processes[display] = processes
+        return computer
+
+    async def terminate(self, processes: list[asyncio.subprocess.Process]):
+        for process in reversed(processes):
+            if process.returncode is None:
+                process.terminate()
+                await process.wait()
+
+    async def shutdown(self, computer: LocalComputer):
+        await asyncio.to_thread(computer.close)
+        await self.terminate(self.processes.pop(computer.display, []))
+
+    async def start(self):
+        computers = await asyncio.gather(*(self.launch() for _ in range(self.size)), return_exceptions=True)
+        for computer in computers:
+            if not isinstance(computer, BaseException):
+                self.computers.put_nowait(computer)
+        error = next((_ for _ in computers if isinstance(_, BaseException)), None)
+        if error:
+            raise error
+
+    async def relaunch(self, attempts: int = 3):
+        for attempt in range(attempts):
+            if self.closing:
+                return
+            try:
+                computer = await self.launch()
+            except Exception as error:
+                print(f"\u26A0\uFE0F  Relaunching a virtual display failed: {type(error).__name__}: {error}")
+                await asyncio.sleep(attempt + 1)
+                continue
+            if self.closing:
+                await self.shutdown(computer)
+            else:
+                self.computers.put_nowait(computer)
+            return
+        self.size -= 1
+        if self.size == 0:
+            self.computers.put_nowait(None)
+
+    async def close(self):
+        self.closing = True
+        while not self.computers.empty():
+            computer = self.computers.get_nowait()
+            if computer is not None:
+                await self.shutdown(computer)
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        computer = await self.computers.get()
+        if computer is None:
+            self.computers.put_nowait(None)
+            raise RuntimeError("No virtual displays are left, all relaunches failed.")
+        try:
+            yield computer
+        finally:
+            await self.shutdown(computer)
+            await self.relaunch()
+
+def create_agent(computer: LocalComputer) -> agents.Agent:
+    return agents.Agent(
         "computer-use",
         "You are a helpful agent. DO NOT ask the user for confirmations.",
         model="gpt-5.4",
         model_settings=agents.ModelSettings(truncation="auto",
             reasoning={"generate_summary": "concise"}),
-        tools=[agents.ComputerTool(LocalComputer())],
+        tools=[agents.ComputerTool(computer)],
     )
-    while True:
-        prompt = input("\U0001F464 User: ")
-        stream = agents.Runner.run_streamed(agent, prompt, max_turns=100)
-        async for event in stream.stream_events():
-            if event.type == 'run_item_stream_event':
-                if event.name == 'tool_called':
-                    action_args = vars(event.item.raw_item.action) | {}
-                    action = action_args.pop("type")
-                    print(f"   {action} {action_args}")
-                elif event.name == "reasoning_item_created":
-                    summary = "".join([_.text for _ in event.item.raw_item.summary])
-                    print(f"\n\U0001F916 Action: {summary}")
-            if event.type == 'raw_response_event':
-                if event.data.type == "response.output_text.done":
-                    print(f"\n\U0001F916 Agent: {event.data.text}\n")
-
-asyncio.run(main())
+
+async def run(agent: agents.Agent, prompt: str, prefix: str = ""):
+    stream = agents.Runner.run_streamed(agent, prompt, max_turns=100)
+    async for event in stream.stream_events():
+        if event.type == 'run_item_stream_event':
+            if event.name == 'tool_called':
+                action_args = vars(event.item.raw_item.action) | {}
+                action = action_args.pop("type")
+                print(f"{prefix}   {action} {action_args}")
+            elif event.name == "reasoning_item_created":
+                summary = "".join([_.text for _ in event.item.raw_item.summary])
+                print(f"\n{prefix}\U0001F916 Action: {summary}")
+        if event.type == 'raw_response_event':
+            if event.data.type == "response.output_text.done":
+                print(f"\n{prefix}\U0001F916 Agent: {event.data.text}\n")
+
+async def main():
+    options = dict(_[2:].partition("=")[::2] for _ in sys.argv[1:] if _.startswith("--"))
+    prompts = [_ for _ in sys.argv[1:] if not _.startswith("--")]
+    with telemetry.session(options.get("telemetry"), "cua"):
+        if "displays" in options:
+            prompts = prompts or [line.strip() for line in sys.stdin if line.strip()]
+            pool = DisplayPool(int(options["displays"] or 1), command=options.get("command", "").split() or None)
+            async def task(prompt: str):
+                async with pool.session() as computer:
+                    print(f"[{computer.display}] \U0001F464 User: {prompt}")
+                    await run(create_agent(computer), prompt, f"[{computer.display}] ")
+            try:
+                await pool.start()
+                results = await asyncio.gather(*(task(prompt) for prompt in prompts), return_exceptions=True)
+            finally:
+                await pool.close()
+            for prompt, result in zip(prompts, results):
+                if isinstance(result, BaseException):
+                    print(f"\u274C {prompt}: {type(result).__name__}: {result}")
+            return
+        agent = create_agent(LocalComputer(fast="fast" in options))
+        while True:
+            await run(agent, input("\U0001F464 User: "))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,12 +1,20 @@
 
 import asyncio
+import hashlib
+import json
+import os
+import random
+import re
 import sys
 import threading
 import time
 
 import agents
+import openai
 import pydantic
 
+import telemetry
+
 
 class Progress:
 
@@ -18,7 +26,7 @@ class Progress:
         status = ""
         while threading.current_thread() is self.thread:
             frame = self.frames[self.index]
-            status = f"\r{self.text}... {frame} {self.status}"
+            status = f"\r{self.text}... {frame} {self.status() if callable(self.status) else self.status}"
             print(status, end="", flush=True)
             time.sleep(0.1)
             self.index = (self.index + 1) % len(self.frames)
@@ -38,6 +46,108 @@ class Progress:
         self.thread = None
         thread.join()
 
+class SearchScheduler:
+
+    transient = (asyncio.TimeoutError, openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+    def __init__(self, concurrency: int = 8, timeout: float = 180, retries: int = 3, backoff: float = 2.0):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.errors = []
+
+    @property
+    def status(self) -> str:
+        status = f"({self.completed}/{self.total} completed"
+        status += f", {self.failed} failed" if self.failed else ""
+        status += f", {self.retried} retries" if self.retried else ""
+        return status + ")"
+
+    async def attempt(self, func, item):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    return await asyncio.wait_for(func(item), self.timeout)
+            except self.transient as error:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                response = getattr(error, "response", None)
+                retry_after = response.headers.get("retry-after", "") if response is not None else ""
+                delay = max(delay, float(retry_after)) if retry_after.replace(".", "", 1).isdigit() else delay
+                with telemetry.span("backoff", error=type(error).__name__, attempt=attempt + 1, delay=round(delay, 3)):
+                    await asyncio.sleep(delay)
+
+    async def run(self, func, items: list):
+        self.total += len(items)
+        tasks = [asyncio.create_task(self.attempt(func, item)) for item in items]
+        for task in asyncio.as_completed(tasks):
+            try:
+                result = await task
+            except Exception as error:
+                self.failed += 1
+                self.errors.append(error)
+                continue
+            self.completed += 1
+            yield result
+
+class SearchCache:
+
+    def __init__(self, path: str | None = None, ttl: float = 6 * 3600, size: int = 16 << 20):
+        self.path = path or os.path.join(os.path.expanduser("~"), ".cache", "agents", "research")
+        self.ttl = ttl
+        self.size = size
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(re.findall(r"\w+", query.lower()))
+
+    def file(self, query: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(self.normalize(query).encode()).hexdigest() + ".json")
+
+    def get(self, query: str) -> str | None:
+        file = self.file(query)
+        try:
+            if time.time() - os.path.getmtime(file) > self.ttl:
+                os.remove(file)
+                return None
+            with open(file, encoding="utf-8") as f:
+                return json.load(f)["summary"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, query: str, summary: str):
+        os.makedirs(self.path, exist_ok=True)
+        file = self.file(query)
+        with open(file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"query": query, "summary": summary}, f)
+        os.replace(file + ".tmp", file)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        with os.scandir(self.path) as iterator:
+            for entry in iterator:
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if total <= self.size and time.time() - mtime <= self.ttl:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
 class SearchQuery(pydantic.BaseModel):
     reason: str = pydantic.Field(description="One‑sentence rationale why this query advances the user’s goal.")
     query: str = pydantic.Field("Exact phrase to paste into the search engine.")
@@ -49,48 +159,160 @@ class Report(pydantic.BaseModel):
     summary: str = pydantic.Field("Less than 75‑word executive summary in plain text.")
     report: str = pydantic.Field("Full Markdown report.")
 
-async def main():
-    user_prompt = sys.argv[1] if len(sys.argv) > 1 else None
-    user_request = input("\U0001F464 User: ") if not user_prompt else user_prompt
+def shingles(query: str) -> set[str]:
+    tokens = SearchCache.normalize(query).split()
+    return set(tokens) | {" ".join(tokens[i : i + 2]) for i in range(len(tokens) - 1)}
+
+def similarity(a: set[str], b: set[str]) -> float:
+    return len(a & b) / max(1, len(a | b))
+
+def deduplicate(searches: list[SearchQuery], threshold: float = 0.6) -> list[SearchQuery]:
+    result = []
+    for search, current in ((_, shingles(_.query)) for _ in searches):
+        if all(similarity(current, other) < threshold for _, other in result):
+            result.append((search, current))
+    return [search for search, _ in result]
+
+class Condenser:
+
+    def __init__(self, agent: agents.Agent, scheduler: SearchScheduler | None = None, size: int = 3, threshold: float = 0.2):
+        self.agent = agent
+        self.scheduler = scheduler or SearchScheduler(concurrency=4)
+        self.size = size
+        self.threshold = threshold
+        self.clusters = []
+        self.tasks = []
+        self.condensed = 0
+
+    def add(self, item: SearchQuery, summary: str):
+        current = shingles(item.query)
+        cluster = max(self.clusters, key=lambda _: similarity(current, _[0]), default=None)
+        if cluster is None or similarity(current, cluster[0]) < self.threshold:
+            cluster = (set(), [])
+            self.clusters.append(cluster)
+        cluster[0].update(current)
+        cluster[1].append((item, summary))
+        if len(cluster[1]) >= self.size:
+            self.clusters.remove(cluster)
+            self.start(cluster[1])
+        elif sum(len(_[1]) for _ in self.clusters) >= 2 * self.size:
+            self.clusters.sort(key=lambda _: len(_[1]), reverse=True)
+            self.start(self.take(self.size))
+
+    def take(self, count: int) -> list:
+        entries = []
+        while self.clusters and len(entries) < count:
+            cluster = self.clusters[0][1]
+            taken = cluster[: count - len(entries)]
+            entries.extend(taken)
+            del cluster[: len(taken)]
+            if not cluster:
+                self.clusters.pop(0)
+        return entries
+
+    def start(self, entries: list):
+        self.tasks.append(asyncio.create_task(self.condense(entries)))
+
+    async def condense(self, entries: list) -> str:
+        queries = "; ".join(item.query for item, _ in entries)
+        content = "\n\n".join(f"### {item.query}\n{summary}" for item, summary in entries)
+        if len(entries) > 1:
+            try:
+                result = await self.scheduler.attempt(lambda _: agents.Runner.run(self.agent, _), content)
+                content = str(result.final_output)
+            except Exception:
+                pass
+        self.condensed += len(entries)
+        return f"Queries: {queries}\n{content}"
+
+    async def finish(self) -> list[str]:
+        while self.clusters:
+            self.start(self.take(self.size))
+        return list(await asyncio.gather(*self.tasks))
+
+def reduce(notes: list[str], budget: int = 24000) -> str:
+    limit = budget * 4 // max(1, len(notes))
+    notes = [note if len(note) <= limit else note[:limit].rsplit(" ", 1)[0] + " ..." for note in notes]
+    return "\n\n".join(f"## Research notes {i + 1}\n{note}" for i, note in enumerate(notes))
+
+async def research(user_request: str, options: dict):
     model_settings = agents.ModelSettings(reasoning={"effort": "low"})
-    with Progress("\U0001F916 Planning"):
+    with Progress("\U0001F916 Planning"), telemetry.span("plan") as data:
         prompt = """You are a research planning assistant.
 Given a query, create a set of web searches to find content to best answer the query.
 Output between 10 and 20 terms to query for."""
         agent = agents.Agent(name="Plan", instructions=prompt, model="gpt-5.4", tools=[agents.WebSearchTool()], model_settings=model_settings, output_type=SearchPlan)
         result = await agents.Runner.run(agent, f"Query: {user_request}")
         plan = result.final_output_as(SearchPlan)
+        data["searches"] = len(plan.searches)
+    searches = deduplicate(plan.searches)
     for item in plan.searches:
-        print(f'\033[90m   {item.query}\033[0m')
-    with Progress("\U0001F50D Searching") as spinner:
+        print(f'\033[90m   {item.query}{"" if any(item is _ for _ in searches) else " (duplicate)"}\033[0m')
+    with Progress("\U0001F50D Searching") as spinner, telemetry.span("search", searches=len(searches)) as data:
         prompt = """You are a research assistant. Search the web based on a given search term and produce a concise summary of the results.
     The summary must be 2-3 paragraphs and less than 300 words. Capture the main points. Write succinctly, no need to have complete sentences or good grammar.
     This will be consumed by an expert synthesizing a report, so its vital to capture the essence and ignore any fluff.
     Do not include any additional commentary other than the summary itself."""
         agent = agents.Agent(name="Search", instructions=prompt, model="gpt-5-mini", tools=[agents.WebSearchTool()], model_settings=agents.ModelSettings(tool_choice="required"))
+        cache = SearchCache()
         async def search_item(item: SearchQuery) -> str:
-            result = await agents.Runner.run(agent, f"Search term: {item.query}\nReason for searching: {item.reason}")
-            return str(result.final_output)
-        completed = 0
-        tasks = [asyncio.create_task(search_item(item)) for item in plan.searches]
-        search_results = []
-        for task in asyncio.as_completed(tasks):
-            result = await task
-            if result is not None:
-                search_results.append(result)
-            completed += 1
-            spinner.status = f"({completed}/{len(tasks)} completed)"
-    with Progress("\U0001F4DD Summarizing"):
-        prompt = """You are a senior researcher tasked with writing a cohesive report for a user query.
+            summary = cache.get(item.query)
+            if summary is None:
+                result = await agents.Runner.run(agent, f"Search term: {item.query}\nReason for searching: {item.reason}")
+                summary = str(result.final_output)
+                cache.set(item.query, summary)
+            return summary
+        prompt = """You are a research assistant. Merge the given search summaries into one set of condensed notes.
+    Keep every distinct fact, number, name, date and source; drop repetition and fluff. Less than 400 words.
+    Do not include any additional commentary other than the notes themselves."""
+        condenser = Condenser(agents.Agent(name="Condense", instructions=prompt, model="gpt-5-mini"))
+        scheduler = SearchScheduler()
+        spinner.status = lambda: f"{scheduler.status[:-1]}, {condenser.condensed} condensed)"
+        async def search_pair(item: SearchQuery) -> tuple[SearchQuery, str]:
+            return item, await search_item(item)
+        async for item, summary in scheduler.run(search_pair, searches):
+            if summary:
+                condenser.add(item, summary)
+        data.update(completed=scheduler.completed, failed=scheduler.failed, retries=scheduler.retried, condensed=condenser.condensed)
+    for error in scheduler.errors:
+        print(f'\033[90m   Search failed: {type(error).__name__} {error}\033[0m')
+    if not condenser.clusters and not condenser.tasks:
+        print("All searches failed.")
+        sys.exit(1)
+    prompt = """You are a senior researcher tasked with writing a cohesive report for a user query.
 You will be provided with the original query, and initial research done by a research assistant.
 First create an outline that describes the structure and flow of the report.
 Then, generate the report and return that as your final output.
 The final output should be detailed in markdown format with for 5-10 pages of content, at least 1000 words."""
+    if "stream" in options:
+        with Progress("\U0001F4DD Condensing"), telemetry.span("condense"):
+            notes = await condenser.finish()
+        prompt += "\nStart with a less than 75-word executive summary in plain text, then the full Markdown report. Output only the report, not the outline."
+        agent = agents.Agent(name="Summary", instructions=prompt, model="gpt-5.4", model_settings=model_settings)
+        print("\U0001F4DD Summarizing\n")
+        with telemetry.span("summarize"):
+            stream = agents.Runner.run_streamed(agent, f"Original query: {user_request}\n\n{reduce(notes, int(options.get('budget') or 24000))}")
+            async for event in stream.stream_events():
+                if event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
+                    print(event.data.delta, end="", flush=True)
+        print()
+        return
+    with Progress("\U0001F4DD Summarizing"), telemetry.span("summarize"):
+        with telemetry.span("condense"):
+            notes = await condenser.finish()
         agent = agents.Agent(name="Summary", instructions=prompt, model="gpt-5.4", model_settings=model_settings, output_type=Report)
-        result = await agents.Runner.run(agent, f"Original query: {user_request}\nSummarized search results: {search_results}")
+        result = await agents.Runner.run(agent, f"Original query: {user_request}\n\n{reduce(notes, int(options.get('budget') or 24000))}")
         report = result.final_output_as(Report)
     print(f"\n\n{report.summary}\n")
     print(f"{report.report}")
 
+async def main():
+    options = dict(_[2:].partition("=")[::2] for _ in sys.argv[1:] if _.startswith("--"))
+    prompts = [_ for _ in sys.argv[1:] if not _.startswith("--")]
+    user_prompt = prompts[0] if prompts else None
+    user_request = input("\U0001F464 User: ") if not user_prompt else user_prompt
+    with telemetry.session(options.get("telemetry"), "research"), agents.trace("research"):
+        await research(user_request, options)
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,142 @@
+import contextlib
+import datetime
+import json
+import threading
+
+import agents
+
+enabled = False
+
+
+@contextlib.contextmanager
+def span(name: str, **data):
+    if not enabled:
+        yield data
+        return
+    with agents.custom_span(name) as current:
+        try:
+            yield data
+        except Exception as error:
+            current.set_error(agents.SpanError(message=f"{type(error).__name__}: {error}", data=None))
+            raise
+        finally:
+            current.span_data.data.update(data)
+
+class Telemetry(agents.TracingProcessor):
+
+    def __init__(self, path: str, service: str):
+        self.file = open(path, "a", encoding="utf-8")
+        self.service = service
+        self.lock = threading.Lock()
+        self.agents = {}
+        self.stats = {}
+
+    @staticmethod
+    def nanoseconds(timestamp: str | None) -> int:
+        return int(datetime.datetime.fromisoformat(timestamp).timestamp() * 1e9) if timestamp else 0
+
+    @staticmethod
+    def attribute(key: str, value) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": value if isinstance(value, str) else json.dumps(value, default=str)}}
+
+    @staticmethod
+    def usage(usage: dict | None) -> dict:
+        usage = usage or {}
+        attributes = {"gen_ai.usage.input_tokens": usage.get("input_tokens", usage.get("prompt_tokens")), "gen_ai.usage.output_tokens": usage.get("output_tokens", usage.get("completion_tokens"))}
+        return {k: v for k, v in attributes.items() if v is not None}
+
+    def describe(self, span: agents.Span) -> tuple[str, dict]:
+        data = span.span_data
+        if data.type == "function":
+            output = "" if data.output is None else data.output if isinstance(data.output, str) else json.dumps(data.output, default=str)
+            return f"tool {data.name}", {"tool.name": data.name, "bytes_in": len((data.input or "").encode()), "bytes_out": len(output.encode())}
+        if data.type in ("response", "generation"):
+            usage = data.usage
+            model = data.model if data.type == "generation" else None
+            if data.type == "response" and data.response is not None:
+                model = data.response.model
+                usage = data.response.usage.model_dump() if data.response.usage else usage
+            return f"model {self.agents.get(span.parent_id, model)}", {"gen_ai.request.model": model} | self.usage(usage)
+        if data.type == "turn":
+            return f"turn {data.agent_name}", {"agent.name": data.agent_name, "turn": data.turn} | self.usage(data.usage)
+        if data.type == "task":
+            return "run", self.usage(data.usage)
+        if data.type == "agent":
+            return f"agent {data.name}", {"agent.name": data.name}
+        if data.type == "custom":
+            return data.name, dict(data.data)
+        return data.type, {}
+
+    def on_trace_start(self, trace: agents.Trace):
+        pass
+
+    def on_trace_end(self, trace: agents.Trace):
+        pass
+
+    def on_span_start(self, span: agents.Span):
+        if span.span_data.type == "agent":
+            self.agents[span.span_id] = span.span_data.name
+
+    def on_span_end(self, span: agents.Span):
+        name, attributes = self.describe(span)
+        start, end = self.nanoseconds(span.started_at), self.nanoseconds(span.ended_at)
+        record = {
+            "traceId": span.trace_id.removeprefix("trace_")[:32],
+            "spanId": span.span_id.removeprefix("span_")[:16],
+            "parentSpanId": span.parent_id.removeprefix("span_")[:16] if span.parent_id else "",
+            "name": name,
+            "kind": 1,
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(end),
+            "attributes": [self.attribute(key, value) for key, value in attributes.items()],
+            "status": {"code": 2, "message": span.error["message"]} if span.error else {"code": 1},
+        }
+        line = {"resourceSpans": [{"resource": {"attributes": [self.attribute("service.name", self.service)]}, "scopeSpans": [{"scope": {"name": "agents"}, "spans": [record]}]}]}
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(json.dumps(line) + "\n")
+            stat = self.stats.setdefault(name, {"durations": [], "errors": 0, "bytes_in": 0, "bytes_out": 0, "input_tokens": 0, "output_tokens": 0})
+            stat["durations"].append((end - start) / 1e6)
+            stat["errors"] += span.error is not None
+            for key, attribute in (("bytes_in", "bytes_in"), ("bytes_out", "bytes_out"), ("input_tokens", "gen_ai.usage.input_tokens"), ("output_tokens", "gen_ai.usage.output_tokens")):
+                stat[key] += attributes.get(attribute) or 0
+
+    def report(self):
+        print(f"\n{'span':<32}{'count':>7}{'total s':>9}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'errors':>8}{'in KB':>9}{'out KB':>9}{'tokens in/out':>16}")
+        for name, stat in sorted(self.stats.items(), key=lambda _: -sum(_[1]["durations"])):
+            durations = sorted(stat["durations"])
+            pick = lambda q: durations[min(len(durations) - 1, round(q * (len(durations) - 1)))]
+            tokens = f"{stat['input_tokens']}/{stat['output_tokens']}" if stat["input_tokens"] or stat["output_tokens"] else "-"
+            print(f"{name[:31]:<32}{len(durations):>7}{sum(durations) / 1000:>9.2f}{pick(0.5):>10.1f}{pick(0.95):>10.1f}{durations[-1]:>10.1f}{stat['errors']:>8}{stat['bytes_in'] / 1024:>9.1f}{stat['bytes_out'] / 1024:>9.1f}{tokens:>16}")
+
+    def shutdown(self):
+        with self.lock:
+            self.file.close()
+
+    def force_flush(self):
+        with self.lock:
+            self.file.flush()
+
+@contextlib.contextmanager
+def session(path: str | None, service: str):
+    global enabled
+    if not path:
+        yield None
+        return
+    telemetry = Telemetry(path, service)
+    agents.set_tracing_disabled(False)
+    agents.add_trace_processor(telemetry)
+    enabled = True
+    try:
+        yield telemetry
+    finally:
+        enabled = False
+        telemetry.shutdown()
+        telemetry.report()